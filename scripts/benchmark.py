@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ =  'Felipe Fronchetti'
+__contact__ = 'fronchetti@usp.br'
+
+import copy
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import telescope.collector as GitHub
+import telescope.repository as GitHubRepository
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection open between requests, as GitHub does.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = json.dumps([{'id': index} for index in range(30)]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-ratelimit-remaining', '5000')
+        self.send_header('x-ratelimit-reset', str(int(time.time()) + 3600))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInServer():
+    def __init__(self, handler=StandInHandler):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return 'http://127.0.0.1:' + str(self.server.server_address[1]) + '/'
+
+    def __exit__(self, *arguments):
+        self.server.shutdown()
+        self.server.server_close()
+
+def requests_per_second(collector, number_of_requests):
+    start = time.time()
+
+    for index in range(number_of_requests):
+        collector.request('repos/owner/name/commits', {'page': index})
+
+    return number_of_requests / (time.time() - start)
+
+def benchmark_pooling(number_of_requests=500):
+    with StandInServer() as api_url:
+        for pool_size in [None, 10]:
+            collector = GitHub.Collector('client_id', 'client_secret', pool_size=pool_size, api_url=api_url)
+            rate = requests_per_second(collector, number_of_requests)
+            collector.close()
+            label = 'pooled (' + str(pool_size) + ')' if pool_size else 'not pooled'
+            print('[Benchmark] Collector ' + label + ': ' + str('{0:.1f}'.format(rate)) + ' requests/s')
+
+class FixtureCollector():
+    # Answers Repository requests from a fixture ({path: items} for listings,
+    # {path: item} for single resources) and counts them.
+
+    def __init__(self, fixture):
+        self.fixture = fixture
+        self.requests = 0
+
+    def page(self, path, parameters={}, headers={}, listing=False):
+        self.requests = self.requests + 1
+        content = copy.deepcopy(self.fixture.get(path))
+
+        if isinstance(content, list):
+            per_page = int(parameters.get('per_page', 30))
+            page = int(parameters.get('page', 1))
+            last_page = max((len(content) + per_page - 1) // per_page, 1)
+            return content[(page - 1) * per_page:page * per_page], last_page
+
+        return content, None
+
+    def request(self, path, parameters={}, headers={}, listing=False):
+        return self.page(path, parameters, headers, listing)[0]
+
+def pull_requests_fixture(number_of_pull_requests=2000, seed=46):
+    # Mimics a recorded project: a third of the pull-requests are merged, and
+    # most of them have a few review and issue comments.
+    generator = random.Random(seed)
+    path = 'repos/owner/name'
+    fixture = {path + '/pulls': [], path + '/pulls/comments': [], path + '/issues/comments': []}
+
+    for number in range(number_of_pull_requests, 0, -1):
+        merged_at = '2018-01-01T00:00:00Z' if generator.random() < 0.33 else None
+        pull_request = {'number': number, 'created_at': '2017-01-01T00:00:00Z', 'merged_at': merged_at, 'user': {'login': 'user'}}
+        fixture[path + '/pulls'].append(pull_request)
+        fixture[path + '/pulls/' + str(number)] = dict(pull_request, merged_by={'login': 'integrator'} if merged_at else None)
+        fixture[path + '/pulls/' + str(number) + '/comments'] = []
+        fixture[path + '/issues/' + str(number) + '/comments'] = []
+
+        for index in range(generator.randint(0, 4)):
+            review = {'pull_request_url': 'https://api.github.com/' + path + '/pulls/' + str(number), 'user': {'login': 'reviewer'}}
+            fixture[path + '/pulls/comments'].append(review)
+            fixture[path + '/pulls/' + str(number) + '/comments'].append(review)
+
+        for index in range(generator.randint(0, 6)):
+            comment = {'issue_url': 'https://api.github.com/' + path + '/issues/' + str(number), 'user': {'login': 'commenter'}}
+            fixture[path + '/issues/comments'].append(comment)
+            fixture[path + '/issues/' + str(number) + '/comments'].append(comment)
+
+    return fixture
+
+def benchmark_pull_requests(fixture_file=None):
+    if fixture_file is not None:
+        with open(fixture_file, 'r') as fixture:
+            fixture = json.load(fixture)
+    else:
+        fixture = pull_requests_fixture()
+
+    results = {}
+
+    for bulk in [False, True]:
+        collector = FixtureCollector(fixture)
+        repository = GitHubRepository.Repository('owner', 'name', collector)
+
+        results[bulk] = repository.pull_requests(state='all', bulk=bulk)
+
+        label = 'bulk' if bulk else 'per pull-request'
+        print('[Benchmark] Pull-requests (' + label + '): ' + str(collector.requests) + ' requests for ' + str(len(results[bulk])) + ' pull-requests')
+
+    for per_item, bulk in zip(results[False], results[True]):
+        if per_item != bulk:
+            print('[Benchmark] The modes disagree on pull-request #' + str(per_item['number']))
+            break
+
+if __name__ == '__main__':
+    benchmark_pooling()
+    benchmark_pull_requests()
@@ -4,6 +4,7 @@
 __author__ =  'Felipe Fronchetti'
 __contact__ = 'fronchetti@usp.br'
 
+import os
 import pandas as pd  
 import numpy as np 
 from sklearn.preprocessing import StandardScaler
@@ -15,13 +16,20 @@ from sklearn.feature_selection import SelectFromModel
 from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import StratifiedShuffleSplit
 from sklearn.externals.joblib import dump, load
+import stages
+
+FEATURES = ['age', 'stars', 'languages', 'main_language', 'owner_type', 'integrators', 'has_license', 'domain', 'has_contributing', 'has_wiki', 'time_for_merge', 'has_code_of_conduct', 'has_issue_template', 'has_pull_request_template']
 
 class RandomForest():
-    def __init__(self, dataset):
+    def __init__(self, dataset, features=FEATURES, threshold=0.7, test_size=0.3, n_estimators=50, random_state=46):
         self.encoder = LabelEncoder()
         self.dataset = dataset.apply(LabelEncoder().fit_transform)
+        # Features correlated above the threshold (Spearman) are removed.
+        self.threshold = threshold
+        self.n_estimators = n_estimators
+        self.random_state = random_state
 
-        self.x_labels = ['age', 'stars', 'languages', 'main_language', 'owner_type', 'integrators', 'has_license', 'domain', 'has_contributing', 'has_wiki', 'time_for_merge', 'has_code_of_conduct', 'has_issue_template', 'has_pull_request_template']
+        self.x_labels = list(features)
         self.y_label = ['cluster']
 
         self.x = self.dataset[self.x_labels]
@@ -29,7 +37,7 @@ class RandomForest():
         
         self.remove_high_correlation()
 
-        stratified_split = StratifiedShuffleSplit(n_splits=1, test_size=0.3)
+        stratified_split = StratifiedShuffleSplit(n_splits=1, test_size=test_size)
         stratified_split.get_n_splits(self.x.values, self.y.values)
         
 
@@ -41,7 +49,7 @@ class RandomForest():
         self.run_classifier()
 
     def remove_high_correlation(self):
-        threshold = 0.7
+        threshold = self.threshold
         correlation_matrix = self.x.corr(method='spearman')
 
         for i in range(len(correlation_matrix.columns)):
@@ -51,7 +59,7 @@ class RandomForest():
 
                     if removed_feature in self.x.columns:
                         print('Removing column ' + removed_feature + ' highly correlated with ' + correlation_matrix.columns[j])
-                        print('Spearmans Rho: ' + str(correlation_matrix.iloc[i, j]) + ' (Greater than 0.7)')
+                        print('Spearmans Rho: ' + str(correlation_matrix.iloc[i, j]) + ' (Greater than ' + str(threshold) + ')')
                         self.x = self.x.drop(removed_feature, 1)
 
     def standardize_features(self):
@@ -60,7 +68,7 @@ class RandomForest():
         self.x_test = scaler.transform(self.x_test)
 
     def run_classifier(self):
-        classifier = RandomForestClassifier(n_estimators = 50, random_state = 46)
+        classifier = RandomForestClassifier(n_estimators = self.n_estimators, random_state = self.random_state)
         classifier.fit(self.x_train, self.y_train.ravel())
 
         y_pred = classifier.predict(self.x_test)
@@ -83,5 +91,26 @@ class RandomForest():
             report_file.write(str(accuracy_score(self.y_test, y_pred)))
             print(accuracy_score(self.y_test, y_pred))
 
-dataset = pd.read_csv('../tables/summary.csv') 
-random_forest = RandomForest(dataset)
\ No newline at end of file
+if __name__ == '__main__':
+    csv_folder = '../tables'
+    parameters = {'features': FEATURES, 'threshold': 0.7, 'test_size': 0.3, 'n_estimators': 50, 'random_state': 46}
+
+    # The classifier runs again only when the summary, the clusters or the
+    # parameters changed (see stages.py).
+    cache = stages.StageCache(csv_folder + '/.stages')
+    inputs = [csv_folder + '/summary.csv', csv_folder + '/clusters.csv']
+    outputs = ['classifier.joblib', 'classification-report.txt']
+    key = cache.key('classifier', inputs, parameters, [__file__])
+
+    if cache.fresh('classifier', key, outputs):
+        print('The classifier is up to date. Skipping.')
+    else:
+        # cluster.py writes the cluster of each project to clusters.csv (older
+        # versions added a cluster column to summary.csv instead).
+        dataset = pd.read_csv(csv_folder + '/summary.csv')
+
+        if os.path.isfile(csv_folder + '/clusters.csv'):
+            clusters = pd.read_csv(csv_folder + '/clusters.csv')
+            dataset = dataset.drop(columns=['cluster'], errors='ignore').merge(clusters, on='name')
+        random_forest = RandomForest(dataset, **parameters)
+        cache.record('classifier', key, outputs)
\ No newline at end of file
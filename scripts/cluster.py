@@ -8,17 +8,21 @@ import os
 from pyksc import ksc
 from pyksc import metrics
 import numpy
+import inflow
+import stages
 from collections import OrderedDict, Counter
-from csv import reader, DictReader, DictWriter
+from csv import reader, DictWriter
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 
 class KSC(object):
-    def __init__(self, projects, time_series, dataset_folder, csv_folder, images_folder):
+    def __init__(self, projects, time_series, dataset_folder, csv_folder, images_folder, bucket='week'):
         self.report_file = open('clustering-report.txt', 'w')
         self.dataset_folder = dataset_folder
         self.csv_folder = csv_folder
         self.images_folder = images_folder
+        # Size of the buckets of the series (see inflow.BUCKETS), for the plots.
+        self.bucket = bucket
 
         self.projects = projects
         self.time_series = numpy.array(time_series)
@@ -37,7 +41,7 @@ class KSC(object):
         beta_cv = []
 
         print('Saving βCV values in "clustering-report.txt" file')
-        self.report_file.write('# βCV (for 2 ≤ k ≤ 15):\n')
+        self.report_file.write('# βCV (for ' + str(min_clusters) + ' ≤ k ≤ ' + str(max_clusters - 1) + '):\n')
 
         for k_i in k_clusters:
             self.get_clusters(k_i)
@@ -82,7 +86,7 @@ class KSC(object):
 
             plt.ylim([0, 475])
             plt.xlim([-75, 3])
-            plt.xlabel('Week', fontsize=24)
+            plt.xlabel(self.bucket.capitalize(), fontsize=24)
             plt.ylabel('# Newcomers', fontsize=24)
             plt.xticks(fontsize=22)
             plt.yticks(fontsize=22)
@@ -100,7 +104,7 @@ class KSC(object):
         print('Saving K-Spectral Centroids (KSC) in "clustering-report.txt" file')
         self.report_file.write('\n# K-Spectral Centroids (KSC):\n')
 
-        for cluster, centroid in zip(range(0, 3), self.centroids):
+        for cluster, centroid in enumerate(self.centroids):
             growth_rate = centroid[0] + centroid[-1] * 100
             self.report_file.write(str(cluster) + ': ' + str(centroid) + ' (Growth:' + str("{0:.2f}".format(growth_rate)) + ')\n')
 
@@ -111,7 +115,7 @@ class KSC(object):
             plt.plot(weeks, centroid, color='black')
             plt.ylim([0, 0.5])
             plt.xlim([-75, 3])
-            plt.xlabel('Week', fontsize=24)
+            plt.xlabel(self.bucket.capitalize(), fontsize=24)
             plt.ylabel('Average', fontsize=24)
             plt.xticks(fontsize=22)
             plt.yticks(fontsize=22)
@@ -123,11 +127,9 @@ class KSC(object):
 
             figure.savefig(filename, bbox_inches='tight', format='eps', dpi=1000)
 
-    def insert_clusters_in_summary_file(self):
-        summary_file = open(self.csv_folder + '/summary.csv', 'r')
-        summary = DictReader(summary_file)
-        output = []    
-
+    def export_clusters(self):
+        # The cluster of each project goes to clusters.csv (name, cluster),
+        # classifier.py joins it with summary.csv.
         if self.assign is not None:
             print('Saving # repositories per cluster in "clustering-report.txt" file')
             self.report_file.write('\n# Repositories (per Cluster):\n')
@@ -139,43 +141,52 @@ class KSC(object):
                 percentage = float(number_of_repositories) / float(total_of_repositories) * 100
                 self.report_file.write(str(cluster) + ': ' + str(number_of_repositories) + ' (%:' + str("{0:.2f}".format(percentage)) + ')\n')
 
-        for project in summary:
-             for name, time_series, cluster in zip(self.projects, self.time_series, self.assign):
-                if project['name'] == str(name):
-                    project['cluster'] = cluster
-                    output.append(project)
-
-        output_file = open(self.csv_folder + '/summary.csv', 'w')
-
-        if 'cluster' in summary.fieldnames:
-            writer = DictWriter(output_file, fieldnames=summary.fieldnames)
-        else:
-            writer = DictWriter(output_file, fieldnames=summary.fieldnames + ['cluster'])
+        with open(self.csv_folder + '/clusters.csv', 'w') as output_file:
+            writer = DictWriter(output_file, fieldnames=['name', 'cluster'])
+            writer.writeheader()
+            writer.writerows({'name': name, 'cluster': cluster} for name, cluster in zip(self.projects, self.assign))
 
-        writer.writeheader()
-        
-        for project in output:
-            writer.writerow(project)
+        self.report_file.close()
 
 if __name__ == '__main__':
     dataset_folder = '../dataset'
     csv_folder = '../tables'
     images_folder = '../plots/'
 
-    newcomers_inflow_file = open(csv_folder + '/inflow.csv' , 'r')
-    newcomers_inflow = DictReader(newcomers_inflow_file)
-    projects = []
-    time_series = []
-
-    for project in newcomers_inflow:
-        project_name = project['project']
-        project_time_series = [project[column] for column in newcomers_inflow.fieldnames if column != 'project']
-        project_time_series = [0.1 if value == '0' else int(value) for value in project_time_series]
-        projects.append(project_name)
-        time_series.append(project_time_series)
-
-    k_spectral = KSC(projects, time_series, dataset_folder, csv_folder, images_folder)
-    k_spectral.plot_beta_cv()
-    k_spectral.plot_clusters(3)
-    k_spectral.plot_centroids()
-    k_spectral.insert_clusters_in_summary_file()
\ No newline at end of file
+    # Resolution of the series to cluster (see inflow.py). When it differs
+    # from the one of inflow.npz, the series are computed again from the
+    # newcomers entries, without reading the commits.
+    bucket = 'week'
+    alignment = 'calendar'
+    # Number of clusters, and the range of k reported in the βCV plot.
+    k = 3
+    min_clusters = 2
+    max_clusters = 16
+
+    # The clustering runs again only when the inflow or the parameters
+    # changed (see stages.py).
+    cache = stages.StageCache(csv_folder + '/.stages')
+    inputs = [csv_folder + '/inflow.npz', csv_folder + '/newcomers.npz']
+    parameters = {'bucket': bucket, 'alignment': alignment, 'k': k, 'min_clusters': min_clusters, 'max_clusters': max_clusters}
+    outputs = [csv_folder + '/clusters.csv', 'clustering-report.txt', images_folder + '/beta_cv.eps']
+    outputs = outputs + [images_folder + '/' + plot + '_' + str(cluster) + '.eps' for plot in ['cluster', 'centroid'] for cluster in range(k)]
+    key = cache.key('cluster', inputs, parameters, [__file__, inflow.__file__])
+
+    if cache.fresh('cluster', key, outputs):
+        print('The clusters are up to date. Skipping.')
+    else:
+        projects, buckets, newcomers_inflow, inflow_bucket, inflow_alignment = inflow.load_inflow(csv_folder + '/inflow.npz')
+
+        if (bucket, alignment) != (inflow_bucket, inflow_alignment):
+            entries = inflow.load_entries(csv_folder + '/newcomers.npz')
+            projects, buckets, newcomers_inflow = inflow.inflow_matrix(entries, bucket, alignment)
+
+        # KSC doesn't handle series of zeros.
+        time_series = numpy.where(newcomers_inflow == 0, 0.1, newcomers_inflow)
+
+        k_spectral = KSC(projects, time_series, dataset_folder, csv_folder, images_folder, bucket)
+        k_spectral.plot_beta_cv(min_clusters, max_clusters)
+        k_spectral.plot_clusters(k)
+        k_spectral.plot_centroids()
+        k_spectral.export_clusters()
+        cache.record('cluster', key, outputs)
@@ -4,23 +4,196 @@ __author__ =  'Felipe Fronchetti'
 __contact__ = 'fronchetti@usp.br'
 
 import multiprocessing
+import logging
+import logging.handlers
+import time
 from functools import partial
 import telescope.collector as GitHub
 import telescope.search as GitHubSearch
 import telescope.repository as GitHubRepository
+import telescope.cache as GitHubCache
+import telescope.journal as GitHubJournal
+import telescope.graphql as GitHubGraphQL
+import telescope.metrics as GitHubMetrics
+import storage
 import json
 import os
+import heapq
+import itertools
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Commits keep the committer date they had on their branch, so a branch
+# merged after the mark brings commits dated before it. Incremental refreshes
+# request the commits of this many days before the mark again, the ones
+# already stored are recognized by their sha.
+COMMIT_OVERLAP_DAYS = 90
+
+# Fields kept for each resource. inflow.py and summary.py only read a few of
+# them, the others are needed to refresh the dataset incrementally (sha,
+# committer date, updated_at...). Paths go through lists, 'reviews.user.login'
+# keeps the login of every review.
+PROJECTIONS = {
+    'commits': ['sha',
+                'commit.author.name',
+                'commit.author.email',
+                'commit.author.date',
+                'commit.committer.date',
+                'author.login'],
+    'stars': ['starred_at',
+              'user.login'],
+    'forks': ['id',
+              'full_name',
+              'created_at',
+              'owner.login'],
+    'pull_requests': ['number',
+                      'state',
+                      'created_at',
+                      'updated_at',
+                      'closed_at',
+                      'merged_at',
+                      'merged_by.login',
+                      'user.login',
+                      'reviews.user.login',
+                      'reviews.created_at',
+                      'comments.user.login',
+                      'comments.created_at']
+}
+
+def project(item, paths):
+    # Copies only the given fields of an item (a dict, or a list of them).
+    if isinstance(item, list):
+        return [project(element, paths) for element in item]
+    if not isinstance(item, dict):
+        return item
+
+    fields = {}
+
+    for path in paths:
+        key, _, rest = path.partition('.')
+        if key in item:
+            fields.setdefault(key, [])
+            if rest:
+                fields[key].append(rest)
+
+    projection = {}
+
+    for key, rest in fields.items():
+        projection[key] = project(item[key], rest) if rest else item[key]
+
+    return projection
+
+def latest(items, path):
+    mark = None
+
+    for item in items:
+        value = storage.field(item, path)
+        if value is not None and (mark is None or value > mark):
+            mark = value
+    return mark
+
+def remember(items, path, seen):
+    # Passes the items through, adding their field to seen.
+    for item in items:
+        seen.add(storage.field(item, path))
+        yield item
 
 class Parser():
-    def __init__(self, repository, folder, collector):
+    def __init__(self, repository, folder, collector, incremental=False, storage_format='json', projection=PROJECTIONS, graphql=None):
         self.repository = repository
         self.name = repository['name']
         self.owner = repository['owner']['login']
         self.folder = folder
         self.collector = GitHubRepository.Repository(self.owner, self.name, collector)
+        # In incremental mode, existing files are refreshed with the items
+        # that appeared after their high-water mark (stored in resource.mark)
+        # instead of being skipped.
+        self.incremental = incremental
+        # Format of the commits, stars, forks and pull-requests files, see
+        # storage.FORMATS (e.g. 'jsonl.gz' for compressed JSON Lines).
+        self.storage_format = storage_format
+        # Fields stored for each resource (see PROJECTIONS). Resources that
+        # aren't listed, or projection='raw', keep the complete payloads.
+        self.projection = projection
+        # Optional telescope.graphql.GraphQLCollector, used by get_timelines.
+        self.graphql = graphql
+
+        # Tasks of the same project may start at once in different workers.
+        os.makedirs(self.folder, exist_ok=True)
+
+    def load_mark(self, resource):
+        if os.path.isfile(self.folder + '/' + resource + '.mark'):
+            with open(self.folder + '/' + resource + '.mark', 'r') as mark_file:
+                return json.load(mark_file)
+
+        # Datasets collected before kept every mark in a single marks.json.
+        if os.path.isfile(self.folder + '/marks.json'):
+            with open(self.folder + '/marks.json', 'r') as marks_file:
+                return json.load(marks_file).get(resource)
+
+        return None
+
+    def save_mark(self, resource, mark):
+        # One file per resource, written aside and renamed: the tasks of a
+        # project run at once in different workers.
+        temporary = self.folder + '/' + resource + '.mark.' + str(os.getpid()) + '.tmp'
+
+        with open(temporary, 'w') as mark_file:
+            json.dump(mark, mark_file)
+
+        os.replace(temporary, self.folder + '/' + resource + '.mark')
+
+    def load(self, resource):
+        return storage.records(self.folder, resource)
 
-        if not os.path.exists(self.folder):
-            os.makedirs(self.folder)
+    def save(self, resource, items, path):
+        # Items are written as they arrive (one page in memory at a time) to a
+        # partial file that only replaces the resource once it is complete.
+        # Returns the high-water mark of the resource, the latest value of path.
+        mark = None
+
+        with storage.RecordWriter(self.folder, resource, self.storage_format) as writer:
+            for item in items:
+                writer.write(self.projected(resource, item))
+
+                value = storage.field(item, path)
+                if value is not None and (mark is None or value > mark):
+                    mark = value
+
+        self.save_mark(resource, mark)
+
+        # The resource is complete, its checkpoints are no longer needed.
+        self.journal(resource).remove()
+
+    def projected(self, resource, item):
+        if self.projection != 'raw' and resource in self.projection:
+            return project(item, self.projection[resource])
+        return item
+
+    def projected_comment(self, field, item):
+        # A review or comment ('reviews' or 'comments') of a pull-request, with
+        # the fields the pull-request keeps for it.
+        paths = [path.partition('.')[2] for path in self.projection['pull_requests'] if path.startswith(field + '.')]
+        return project(item, paths)
+
+    def journal(self, resource):
+        # Pages are checkpointed as they arrive. If the crawl stops, the next
+        # run resumes the listing from the last completed page.
+        return GitHubJournal.Journal(self.folder + '/' + resource + '.journal')
+
+    def refresh(self, resource, path):
+        # Returns whether the resource must be (re)collected and its high-water
+        # mark (the latest value of path), None when it must be collected
+        # from scratch.
+        if not storage.exists(self.folder, resource):
+            return True, None
+        if self.incremental:
+            mark = self.load_mark(resource)
+            if mark is None:
+                mark = latest(self.load(resource), path)
+            return True, mark
+        return False, None
 
     def get_about(self):
         if not os.path.isfile(self.folder + '/about.json'):
@@ -29,7 +202,7 @@ class Parser():
             with open(self.folder + '/about.json', 'w') as about_file:
                 json.dump(about, about_file)
         else:
-            print(self.repository['name'] + ' already contains an about file. Skipping.')
+            logger.info(self.repository['name'] + ' already contains an about file. Skipping.')
 
     def get_languages(self):
         if not os.path.isfile(self.folder + '/languages.json'):
@@ -38,7 +211,7 @@ class Parser():
             with open(self.folder + '/languages.json', 'w') as languages_file:
                 json.dump(languages, languages_file)
         else:
-            print(self.repository['name'] + ' already contains a languages file. Skipping.')
+            logger.info(self.repository['name'] + ' already contains a languages file. Skipping.')
 
     def get_community_metrics(self):
         if not os.path.isfile(self.folder + '/metrics.json'):
@@ -47,93 +220,314 @@ class Parser():
             with open(self.folder + '/metrics.json', 'w') as metrics_file:
                 json.dump(metrics, metrics_file)
         else:
-            print(self.repository['name'] + ' already contains a metrics file. Skipping.')
+            logger.info(self.repository['name'] + ' already contains a metrics file. Skipping.')
+
+    def get_timelines(self):
+        # With the GraphQL backend, the pull-requests (with reviews and
+        # comments), stars and forks that are still missing are collected
+        # together, each query carrying a page of every one of them. The
+        # pages are checkpointed in timelines.journal.
+        if self.graphql is None:
+            return
+
+        paths = {'pull_requests': 'updated_at', 'stars': 'starred_at', 'forks': 'created_at'}
+        resources = [resource for resource in ['pull_requests', 'stars', 'forks'] if not storage.exists(self.folder, resource)]
+
+        if not resources:
+            return
+
+        repository = GitHubGraphQL.GraphQLRepository(self.owner, self.name, self.graphql)
+        writers = dict((resource, storage.RecordWriter(self.folder, resource, self.storage_format)) for resource in resources)
+        marks = dict((resource, None) for resource in resources)
+
+        try:
+            for resource, page in repository.timelines(resources, journal=self.journal('timelines')):
+                for item in page:
+                    writers[resource].write(self.projected(resource, item))
+
+                    value = storage.field(item, paths[resource])
+                    if value is not None and (marks[resource] is None or value > marks[resource]):
+                        marks[resource] = value
+        except:
+            for writer in writers.values():
+                writer.discard()
+            raise
+
+        for resource in resources:
+            writers[resource].close()
+            self.save_mark(resource, marks[resource])
+
+        self.journal('timelines').remove()
 
     def get_stars(self):
-        if not os.path.isfile(self.folder + '/stars.json'):
-            stars = self.collector.stars()
+        collect, mark = self.refresh('stars', 'starred_at')
 
-            with open(self.folder + '/stars.json', 'w') as stars_file:
-                json.dump(stars, stars_file)
+        if collect:
+
+            if mark is None:
+                stars = self.collector.iter_stars(journal=self.journal('stars'))
+            else:
+                # Stargazers are listed from oldest to newest. The known pages
+                # are skipped (starting one page early, in case of unstars).
+                per_page = self.collector.per_page
+                first_item = max(sum(1 for star in self.load('stars')) - per_page, 0)
+                page_range = {'first_page': first_item // per_page + 1, 'per_page': per_page}
+                stars = itertools.chain(self.load('stars'), self.collector.iter_stars(since=mark, page_range=page_range, journal=self.journal('stars')))
+
+            self.save('stars', stars, 'starred_at')
         else:
-            print(self.repository['name'] + ' already contains a stars file. Skipping.')
+            logger.info(self.repository['name'] + ' already contains a stars file. Skipping.')
 
     def get_forks(self):
-        if not os.path.isfile(self.folder + '/forks.json'):
-            forks = self.collector.forks()
+        collect, mark = self.refresh('forks', 'created_at')
+
+        if collect:
+
+            if mark is None:
+                forks = self.collector.iter_forks(journal=self.journal('forks'))
+            else:
+                forks = itertools.chain(self.collector.iter_forks(sort='newest', since=mark, journal=self.journal('forks')), self.load('forks'))
 
-            with open(self.folder + '/forks.json', 'w') as forks_file:
-                json.dump(forks, forks_file)
+            self.save('forks', forks, 'created_at')
         else:
-            print(self.repository['name'] + ' already contains a forks file. Skipping.')
+            logger.info(self.repository['name'] + ' already contains a forks file. Skipping.')
 
     def get_commits(self):
-        if not os.path.isfile(self.folder + '/commits.json'):
-            commits = self.collector.commits()
+        collect, mark = self.refresh('commits', 'commit.committer.date')
+
+        if collect:
 
-            with open(self.folder + '/commits.json', 'w') as commits_file:
-                json.dump(commits, commits_file)
+            if mark is None:
+                commits = self.collector.iter_commits(journal=self.journal('commits'))
+            else:
+                # Commits in the overlap come back again and replace their
+                # stored copy (see COMMIT_OVERLAP_DAYS).
+                since = datetime.strptime(mark, '%Y-%m-%dT%H:%M:%SZ') - timedelta(days=COMMIT_OVERLAP_DAYS)
+                shas = set()
+                commits = remember(self.collector.iter_commits(since=since.strftime('%Y-%m-%dT%H:%M:%SZ'), journal=self.journal('commits')), 'sha', shas)
+                commits = itertools.chain(commits, (commit for commit in self.load('commits') if commit['sha'] not in shas))
+
+            self.save('commits', commits, 'commit.committer.date')
         else:
-            print(self.repository['name'] + ' already contains a commits file. Skipping.')
+            logger.info(self.repository['name'] + ' already contains a commits file. Skipping.')
 
     def get_pull_requests(self):
-        try:
-            if not os.path.isfile(self.folder + '/pull_requests.json'):
-                pull_requests = self.collector.pull_requests(state='all')
+        collect, mark = self.refresh('pull_requests', 'updated_at')
 
-                with open(self.folder + '/pull_requests.json', 'w') as pull_requests_file:
-                    json.dump(pull_requests, pull_requests_file)
+        if collect:
+
+            if mark is None:
+                # Bulk mode joins the repository-wide comment listings instead of
+                # requesting every pull-request. Fields found only in the details
+                # of unmerged pull-requests (additions, mergeable...) are then
+                # missing, which only matters when keeping raw payloads.
+                bulk = self.projection != 'raw'
+                compact = self.projected_comment if bulk and 'pull_requests' in self.projection else None
+                comment_journals = (self.journal('pull_request_reviews'), self.journal('pull_request_comments'))
+                pull_requests = self.collector.iter_pull_requests(state='all', journal=self.journal('pull_requests'), bulk=bulk, comment_journals=comment_journals, compact=compact)
             else:
-                print(self.repository['name'] + ' already contains a pull-requests file. Skipping.')
-        except:
-            raise
+                # Pull-requests updated after the mark replace their stored
+                # version, the file stays sorted by number (newest first).
+                updated = self.collector.pull_requests(state='all', sort='updated', direction='desc', since=mark, journal=self.journal('pull_requests'))
+                updated.sort(key=lambda pull_request: pull_request['number'], reverse=True)
+                numbers = set(pull_request['number'] for pull_request in updated)
+                stored = (pull_request for pull_request in self.load('pull_requests') if pull_request['number'] not in numbers)
+                pull_requests = heapq.merge(updated, stored, key=lambda pull_request: -pull_request['number'])
+
+            self.save('pull_requests', pull_requests, 'updated_at')
+
+            if mark is None:
+                for journal in comment_journals:
+                    journal.remove()
+        else:
+            logger.info(self.repository['name'] + ' already contains a pull-requests file. Skipping.')
 
-def popular_projects_per_language(languages, dataset_folder, collector):
-    search = GitHubSearch.Search(collector)
+def popular_projects_per_language(languages, dataset_folder, collector, min_stars=None):
+    # The study uses the 30 most popular projects of each language. With
+    # min_stars, every project of the language with at least that many stars
+    # is harvested instead (see Search.harvest).
+    search = GitHubSearch.Search(collector, per_page=30 if min_stars is None else 100)
     repositories = {}
 
     for language in languages:
-        print('Looking for repositories written in: ' + language + '. (Sorted by number of stars)')
-        repositories[language] = search.repositories(keywords='language:' + language.lower(), sort='stars')
+        logger.info('Looking for repositories written in: ' + language + '. (Sorted by number of stars)')
+        if min_stars is None:
+            repositories[language] = search.repositories(keywords='language:' + language.lower(), sort='stars')
+        else:
+            items = search.harvest('language:' + language.lower(), min_stars=min_stars)
+            repositories[language] = {'total_count': len(items), 'items': items}
 
     with open(dataset_folder + '/projects.json', 'w') as projects_file:
         json.dump(repositories, projects_file)
 
     return repositories
 
-def repositories_in_parallel(repository, dataset_folder, language):
-    print('Collecting data from: ' + repository['name'])
+def project_repositories(projects):
+    # projects.json holds one search response per language (or a list of
+    # them, one per page). Returns (language, repository) pairs.
+    repositories = []
+
+    for language in projects.keys():
+        pages = projects[language]
+
+        if isinstance(pages, dict):
+            pages = [pages]
+
+        for page in pages:
+            if page and 'items' in page:
+                for repository in page['items']:
+                    repositories.append((language, repository))
+
+    return repositories
+
+def size_hints(repository, folder):
+    # about.json is more recent than the search results, when it exists.
+    if os.path.isfile(folder + '/about.json'):
+        with open(folder + '/about.json', 'r') as about_file:
+            about = json.load(about_file)
+        if about and 'stargazers_count' in about:
+            return about
+    return repository
+
+def task_cost(hints, resource):
+    # Rough number of requests of a task. There is no count of commits or
+    # pull-requests before collecting them, popularity stands in for activity.
+    stars = hints.get('stargazers_count') or 0
+    forks = hints.get('forks_count') or 0
+
+    if resource == 'stars':
+        return stars
+    if resource == 'forks':
+        return forks
+    if resource in ['commits', 'pull_requests']:
+        return stars + forks
+    if resource == 'timelines':
+        return 2 * (stars + forks)
+    return 1
+
+def crawl_tasks(projects, dataset_folder, graphql=None):
+    # One task per (project, resource) of every language, largest first, so
+    # the biggest projects never start last and keep a single worker busy.
+    tasks = []
+
+    for language, repository in project_repositories(projects):
+        folder = dataset_folder + '/' + language + '/' + repository['name']
+        hints = size_hints(repository, folder)
+        resources = ['about', 'languages', 'metrics', 'pull_requests', 'commits', 'stars', 'forks']
+
+        if graphql is not None:
+            # get_timelines collects the missing pull-requests, stars and
+            # forks, the existing ones are still refreshed through REST.
+            timelines = [resource for resource in ['pull_requests', 'stars', 'forks'] if not storage.exists(folder, resource)]
+            resources = ['timelines'] + [resource for resource in resources if resource not in timelines]
+
+        for resource in resources:
+            tasks.append((task_cost(hints, resource), language, repository, resource))
+
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    return [(language, repository, resource) for cost, language, repository, resource in tasks]
+
+def crawl_task(task, dataset_folder, incremental=False, storage_format='json', projection=PROJECTIONS):
+    language, repository, resource = task
     folder = dataset_folder + '/' + language + '/' + repository['name']
-    project = Parser(repository, folder, collector)
-    project.get_about()
-    project.get_languages()
-    project.get_pull_requests()
-    project.get_commits()
-    project.get_stars()
-    project.get_forks()
-    project.get_community_metrics()
+
+    # A failed task must not stop the crawl, it is reported and runs again
+    # (resuming from its journal) the next time dataset.py is executed.
+    try:
+        project = Parser(repository, folder, collector, incremental, storage_format, projection, graphql)
+        methods = {'about': project.get_about,
+                   'languages': project.get_languages,
+                   'metrics': project.get_community_metrics,
+                   'timelines': project.get_timelines,
+                   'pull_requests': project.get_pull_requests,
+                   'commits': project.get_commits,
+                   'stars': project.get_stars,
+                   'forks': project.get_forks}
+
+        logger.info('Collecting ' + resource + ' from: ' + repository['full_name'])
+        methods[resource]()
+        return task, None
+    except Exception as error:
+        return task, repr(error)
+    finally:
+        # Each worker records its own metrics, they are written (and added
+        # up later) once per task.
+        if collector.metrics is not None:
+            collector.metrics.flush()
+
+def crawl(projects, dataset_folder, processes=4, **options):
+    tasks = crawl_tasks(projects, dataset_folder, graphql)
+    failures = []
+    parallel = multiprocessing.Pool(processes=processes)
+
+    # Workers take the next task from a shared queue as soon as they are idle
+    # (chunksize=1), there is no barrier between languages or pages.
+    for index, (task, error) in enumerate(parallel.imap_unordered(partial(crawl_task, dataset_folder=dataset_folder, **options), tasks, chunksize=1)):
+        if error is not None:
+            language, repository, resource = task
+            logger.error('Failed to collect ' + resource + ' from ' + repository['full_name'] + ': ' + error)
+            failures.append(task)
+        logger.info('[Crawl] ' + str(index + 1) + ' of ' + str(len(tasks)) + ' tasks finished')
+
+    parallel.close()
+    parallel.join()
+    return failures
 
 if __name__ == '__main__':
     api_client_id = str('4161a8257efaea420c94') # Add your own client id
     api_client_secret = str('d814ec48927a6bd62c55c058cd028a949e5362d4') # Add your own client secret
-    collector = GitHub.Collector(api_client_id, api_client_secret)
+    # Requests are spread over every credential listed here, add more pairs
+    # (or OAuth tokens) to crawl without waiting for a single rate limit.
+    credentials = [(api_client_id, api_client_secret)]
     dataset_folder = '../dataset'
-    parallel = multiprocessing.Pool(processes=4)
+    # Progress goes to the console, warnings and errors (failed requests,
+    # retries...) also go to exceptions.log, rotated every 10 MB.
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    exceptions = logging.handlers.RotatingFileHandler('exceptions.log', maxBytes=10 * 1024 ** 2, backupCount=5)
+    exceptions.setLevel(logging.WARNING)
+    exceptions.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+    logging.getLogger().addHandler(exceptions)
+    # Requests, latencies, bytes, cache hits, retries and rate limit waits
+    # per endpoint. Every worker appends its numbers to metrics.jsonl, the
+    # totals of the run are written to metrics.prom (Prometheus text format).
+    started = time.time()
+    metrics_sink = GitHubMetrics.JSONLinesSink(dataset_folder + '/metrics.jsonl')
+    metrics = GitHubMetrics.Metrics([metrics_sink])
+    # Responses are kept on disk and revalidated with ETags on later runs,
+    # GitHub doesn't charge the rate limit for unchanged (304) responses.
+    cache = GitHubCache.ResponseCache(dataset_folder + '/.cache', max_size=20 * 1024 ** 3, compress=True)
+    collector = GitHub.Collector(credentials=credentials, cache=cache, metrics=metrics)
+    # OAuth tokens listed here enable the GraphQL backend for pull-requests,
+    # stars and forks (one query returns a page of each of them).
+    graphql_tokens = []
+    graphql = GitHubGraphQL.GraphQLCollector(graphql_tokens, metrics=metrics) if graphql_tokens else None
+    # Set to True to refresh an existing dataset with the new commits, stars,
+    # forks and pull-requests only.
+    incremental = False
+    # Format of the largest files (commits, stars, forks and pull-requests):
+    # 'json', 'jsonl', 'jsonl.gz' or 'jsonl.zst' (requires zstandard).
+    storage_format = 'jsonl.gz'
+    # Fields stored for each resource, use 'raw' to keep the complete payloads.
+    projection = PROJECTIONS
 
     if os.path.isfile(dataset_folder + '/projects.json'):
         with open(dataset_folder + '/projects.json', 'r') as projects_file:
             projects = json.load(projects_file)
     else:
-        print('File with most popular projects per language does not exist. Generating one.')
+        logger.info('File with most popular projects per language does not exist. Generating one.')
 
         languages = ['C', 'CoffeeScript', 'Clojure', 'Erlang',
             'Go', 'Haskell', 'Java', 'JavaScript', 'Objective-C',
             'Perl', 'PHP', 'Python', 'Ruby', 'Scala', 'TypeScript']
 
-        projects = popular_projects_per_language(languages, dataset_folder, collector)
+        # Set to a number of stars to harvest every project above it, instead
+        # of the 30 most popular ones of each language.
+        min_stars = None
+        projects = popular_projects_per_language(languages, dataset_folder, collector, min_stars)
+        metrics.flush()
 
-    for language in projects.keys():
-	for index, page in enumerate(projects[language]):
-		print('Downloading page ' + str(index) + ' of most popular projects written in ' + str(language))
-		repositories = projects[language][index]['items']
-	        parallel.map(partial(repositories_in_parallel, dataset_folder=dataset_folder, language=language), repositories)
+    failures = crawl(projects, dataset_folder, processes=4, incremental=incremental, storage_format=storage_format, projection=projection)
+    logger.info('Crawl finished, ' + str(len(failures)) + ' tasks failed.')
+
+    with open(dataset_folder + '/metrics.prom', 'w') as metrics_file:
+        metrics_file.write(GitHubMetrics.prometheus(GitHubMetrics.merge(snapshot for snapshot in metrics_sink.snapshots() if snapshot['time'] >= started)))
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ =  'Felipe Fronchetti'
+__contact__ = 'fronchetti@usp.br'
+
+import os
+import numpy
+import storage
+
+# Compact, columnar copy of the events of a project (commits, stars, forks
+# and pull-requests), kept in events.npz next to the resource files. Dates
+# are days since 1970-01-01 and authors are ids into string tables, so the
+# analyses never parse JSON or dates again:
+#
+# commit_days, commit_names, commit_emails, commit_logins -> names, emails, logins
+# star_days
+# fork_days
+# pull_request_created, pull_request_merged, pull_request_integrators -> logins
+#
+# Missing dates are MISSING and missing authors -1.
+MISSING = numpy.iinfo(numpy.int32).min
+SOURCES = ['commits', 'stars', 'forks', 'pull_requests']
+# Ways of telling commit authors apart:
+# 'name': the author name of the commit (as in the original study).
+# 'email': the author email of the commit.
+# 'login': the GitHub account of the author, or its email (then name) when
+#          the commit isn't linked to an account.
+IDENTITIES = ['name', 'email', 'login']
+
+def filename(folder):
+    return folder + '/events.npz'
+
+def days(timestamps):
+    # ISO 8601 timestamps (or None) to days since the epoch, all at once.
+    values = numpy.array([timestamp[:10] if timestamp else 'NaT' for timestamp in timestamps], dtype='datetime64[D]')
+    result = values.astype(numpy.int64)
+    result[numpy.isnat(values)] = MISSING
+    return result.astype(numpy.int32)
+
+class Table():
+    # Interns strings: each distinct value gets the next id.
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def id(self, value):
+        if value is None:
+            return -1
+        if value not in self.ids:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+        return self.ids[value]
+
+def compact(folder):
+    # Reads the resource files of a project once and writes events.npz.
+    names = Table()
+    emails = Table()
+    logins = Table()
+    arrays = {}
+
+    if storage.exists(folder, 'commits'):
+        timestamps = []
+        commit_names = []
+        commit_emails = []
+        commit_logins = []
+
+        for commit in storage.records(folder, 'commits'):
+            timestamps.append(storage.field(commit, 'commit.author.date'))
+            commit_names.append(names.id(storage.field(commit, 'commit.author.name')))
+            commit_emails.append(emails.id(storage.field(commit, 'commit.author.email')))
+            commit_logins.append(logins.id(storage.field(commit, 'author.login')))
+
+        arrays['commit_days'] = days(timestamps)
+        arrays['commit_names'] = numpy.array(commit_names, dtype=numpy.int32)
+        arrays['commit_emails'] = numpy.array(commit_emails, dtype=numpy.int32)
+        arrays['commit_logins'] = numpy.array(commit_logins, dtype=numpy.int32)
+
+    if storage.exists(folder, 'stars'):
+        arrays['star_days'] = days(star['starred_at'] for star in storage.records(folder, 'stars'))
+
+    if storage.exists(folder, 'forks'):
+        arrays['fork_days'] = days(fork['created_at'] for fork in storage.records(folder, 'forks'))
+
+    if storage.exists(folder, 'pull_requests'):
+        created = []
+        merged = []
+        integrators = []
+
+        for pull_request in storage.records(folder, 'pull_requests'):
+            created.append(pull_request['created_at'])
+            merged.append(pull_request['merged_at'])
+            merged_by = pull_request.get('merged_by')
+
+            if merged_by is None:
+                integrators.append(-1)
+            else:
+                integrators.append(logins.id(merged_by.get('login', 'Anonymous')))
+
+        arrays['pull_request_created'] = days(created)
+        arrays['pull_request_merged'] = days(merged)
+        arrays['pull_request_integrators'] = numpy.array(integrators, dtype=numpy.int32)
+
+    arrays['names'] = numpy.array(names.values, dtype=str)
+    arrays['emails'] = numpy.array(emails.values, dtype=str)
+    arrays['logins'] = numpy.array(logins.values, dtype=str)
+
+    # Written aside and renamed, as the resource files.
+    temporary = folder + '/partial.events.npz'
+    numpy.savez_compressed(temporary, **arrays)
+    os.replace(temporary, filename(folder))
+
+    return arrays
+
+def stale(folder):
+    # events.npz is older than (or missing) one of the resource files.
+    if not os.path.isfile(filename(folder)):
+        return True
+
+    modified = os.path.getmtime(filename(folder))
+
+    for resource in SOURCES:
+        path = storage.find(folder, resource)
+        if path is not None and os.path.getmtime(path) > modified:
+            return True
+
+    return False
+
+def load(folder):
+    # Returns the events of a project, compacting them first if needed.
+    if stale(folder):
+        return compact(folder)
+
+    with numpy.load(filename(folder)) as data:
+        return dict((name, data[name]) for name in data.files)
+
+def commit_authors(events, by='name', casefold=False):
+    # Author id of each commit (-1 when unknown) and the table of authors,
+    # telling authors apart by one of IDENTITIES, optionally ignoring case
+    # and surrounding spaces. Commits without a date keep their author (see
+    # newcomers.first_days).
+    if by not in IDENTITIES:
+        raise ValueError('Unknown identity: ' + str(by))
+
+    if 'commit_days' not in events:
+        return numpy.zeros(0, dtype=numpy.int32), []
+
+    tables = {'name': events['names'], 'email': events['emails'], 'login': events['logins']}
+    authors = Table()
+    ids = {}
+
+    # Strings are mapped to author ids once per table, not once per commit.
+    for source, table in tables.items():
+        mapping = [authors.id(entry.strip().casefold() if casefold else entry) for entry in table.tolist()]
+        ids[source] = numpy.array(mapping + [-1], dtype=numpy.int32)
+
+    # Index -1 (unknown) reads the last element, -1 as well.
+    result = ids[by][events['commit_' + by + 's']]
+
+    if by == 'login':
+        # Commits without an account fall back to the email, then the name.
+        email = ids['email'][events['commit_emails']]
+        name = ids['name'][events['commit_names']]
+        result = numpy.where(result >= 0, result, numpy.where(email >= 0, email, name))
+
+    return result, authors.values
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ =  'Felipe Fronchetti'
+__contact__ = 'fronchetti@usp.br'
+
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse
+from benchmark import StandInServer
+import telescope.collector as GitHub
+import telescope.repository as GitHubRepository
+
+# Faults served by FaultHandler, by path: how many requests go wrong before
+# the page is served, and what goes wrong. 'always' never serves the page.
+FAULTS = {'/repos/owner/name/bad-gateway': (2, 'bad-gateway'),
+          '/repos/owner/name/dropped': (2, 'dropped'),
+          '/repos/owner/name/truncated': (2, 'truncated'),
+          '/repos/owner/name/secondary': (1, 'secondary'),
+          '/repos/owner/name/retry-after': (1, 'retry-after'),
+          '/repos/owner/name/not-found': ('always', 'not-found'),
+          '/search/repositories': (1, 'search-limit'),
+          '/repos/owner/name/limited': ('always', 'core-limit'),
+          '/repos/owner/name/commits': ('always', 'empty'),
+          '/repos/owner/name/unavailable': ('always', 'bad-gateway')}
+
+PAGE = [{'id': index} for index in range(30)]
+
+class FaultHandler(BaseHTTPRequestHandler):
+    # Stand-in for the GitHub API that fails on purpose, see FAULTS.
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+    requests = {}
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            number = self.requests[path]
+
+        failures, fault = FAULTS.get(path, (0, None))
+
+        if failures == 'always' or number <= failures:
+            if fault == 'dropped':
+                # Closes the connection without answering.
+                self.close_connection = True
+                return
+            if fault == 'truncated':
+                body = json.dumps(PAGE).encode('utf-8')
+                return self.reply(200, body[:len(body) // 2])
+            if fault == 'bad-gateway':
+                return self.reply(502, b'<html><body>502 Bad Gateway</body></html>')
+            if fault == 'secondary':
+                return self.reply(403, b'{"message": "You have exceeded a secondary rate limit."}')
+            if fault == 'retry-after':
+                return self.reply(403, b'{"message": "You have exceeded a secondary rate limit."}', {'Retry-After': '1'})
+            if fault == 'search-limit':
+                # The search bucket resets long before the core one.
+                return self.reply(403, b'{"message": "API rate limit exceeded."}', {'x-ratelimit-resource': 'search', 'x-ratelimit-remaining': '0', 'x-ratelimit-reset': str(int(time.time()) + 1)})
+            if fault == 'core-limit':
+                # A window that is already over: the same token comes back at once.
+                return self.reply(403, b'{"message": "API rate limit exceeded."}', {'x-ratelimit-remaining': '0', 'x-ratelimit-reset': str(int(time.time()) - 1)})
+            if fault == 'not-found':
+                return self.reply(404, b'{"message": "Not Found"}')
+            if fault == 'empty':
+                return self.reply(409, b'{"message": "Git Repository is empty."}')
+
+        self.reply(200, json.dumps(PAGE).encode('utf-8'))
+
+    def reply(self, status, body, headers={}):
+        headers = dict({'x-ratelimit-remaining': '5000', 'x-ratelimit-reset': str(int(time.time()) + 3600)}, **headers)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def requests_to(resource):
+    if resource.startswith('/search/'):
+        return FaultHandler.requests.get(resource, 0)
+    return FaultHandler.requests.get('/repos/owner/name' + resource, 0)
+
+def recovers(collector, resource, attempts, minimum_seconds=0):
+    # The page comes back once the fault is over, after the given attempts.
+    started = time.time()
+    content = collector.request(resource[1:] if resource.startswith('/search/') else 'repos/owner/name' + resource)
+    elapsed = time.time() - started
+
+    if content != PAGE:
+        return 'unexpected content: ' + str(content)[:80]
+    if requests_to(resource) != attempts:
+        return str(requests_to(resource)) + ' requests instead of ' + str(attempts)
+    if elapsed < minimum_seconds:
+        return 'retried after ' + str(round(elapsed, 2)) + ' seconds instead of ' + str(minimum_seconds)
+    return None
+
+def fails(call, status, attempts, resource):
+    # The call raises CollectorError with the status, after the given attempts.
+    try:
+        content = call()
+        return 'returned ' + str(content)[:80] + ' instead of raising CollectorError'
+    except GitHub.CollectorError as error:
+        if error.status != status:
+            return 'CollectorError with status ' + str(error.status) + ' instead of ' + str(status)
+    if requests_to(resource) != attempts:
+        return str(requests_to(resource)) + ' requests instead of ' + str(attempts)
+    return None
+
+def fault_injection():
+    failed = 0
+
+    with StandInServer(FaultHandler) as api_url:
+        collector = GitHub.Collector('client_id', 'client_secret', api_url=api_url, retries=3, backoff=0.01, secondary_wait=0.5)
+        repository = GitHubRepository.Repository('owner', 'name', collector)
+
+        scenarios = [('502 Bad Gateway', lambda: recovers(collector, '/bad-gateway', 3)),
+                     ('Dropped connection', lambda: recovers(collector, '/dropped', 3)),
+                     ('Truncated body', lambda: recovers(collector, '/truncated', 3)),
+                     ('Secondary limit without Retry-After', lambda: recovers(collector, '/secondary', 2, collector.secondary_wait)),
+                     ('Secondary limit with Retry-After', lambda: recovers(collector, '/retry-after', 2, 1)),
+                     ('Primary limit of the search bucket', lambda: recovers(collector, '/search/repositories', 2, 1)),
+                     ('Primary limit retried at most retries times', lambda: fails(lambda: collector.request('repos/owner/name/limited'), 403, collector.retries + 1, '/limited')),
+                     ('404 Not Found (not retried)', lambda: fails(lambda: repository.listing('/not-found'), 404, 1, '/not-found')),
+                     ('409 Empty repository (not retried)', lambda: fails(lambda: repository.commits(), 409, 1, '/commits')),
+                     ('Exhausted retries', lambda: fails(lambda: collector.request('repos/owner/name/unavailable'), 502, collector.retries + 1, '/unavailable'))]
+
+        for label, scenario in scenarios:
+            failure = scenario()
+
+            if failure is None:
+                print('[Faults] ' + label + ': ok')
+            else:
+                print('[Faults] ' + label + ': FAILED, ' + failure)
+                failed = failed + 1
+
+        collector.close()
+
+    return failed
+
+if __name__ == '__main__':
+    sys.exit(1 if fault_injection() else 0)
@@ -7,113 +7,250 @@ __contact__ = "fronchetti@usp.br"
 import os
 import csv
 import json
-from dateutil.relativedelta import relativedelta
-from datetime import datetime, timedelta
-from collections import Counter
+import numpy
+import multiprocessing
+import events
+import stages
+import storage
+import newcomers
+from datetime import datetime, date, timedelta
+from functools import partial
+
+# Source files the newcomers entries and the inflow depend on, see
+# stages.StageCache.key.
+CODE = [__file__, events.__file__, newcomers.__file__, storage.__file__]
+
+# Size of the buckets of an inflow series.
+BUCKETS = ['day', 'week', 'month']
+# 'calendar': every project shares the same buckets (as in the study), from
+#             the creation of the most recent project on.
+# 'relative': bucket 0 of each project starts on the day it was created, and
+#             the series last as long as the youngest project.
+ALIGNMENTS = ['calendar', 'relative']
+EPOCH = date(1970, 1, 1)
+
+def epoch_days(day):
+    return (day - EPOCH).days
+
+def months(days):
+    return numpy.asarray(days, dtype=numpy.int64).astype('datetime64[D]').astype('datetime64[M]').astype(numpy.int64)
+
+def bucket_indices(days, bucket='week', origin=None):
+    # Maps days (since 1970-01-01) to bucket numbers. Calendar buckets are
+    # numbered from the epoch: day 0 is 1970-01-01, week 0 starts on Monday
+    # 1969-12-29 (weeks start on Mondays, as ISO weeks) and month 0 is
+    # January 1970. Given an origin day, buckets are counted from it instead.
+    if bucket not in BUCKETS:
+        raise ValueError('Unknown bucket: ' + str(bucket))
+
+    days = numpy.asarray(days, dtype=numpy.int64)
+
+    if origin is None:
+        if bucket == 'day':
+            return days
+        if bucket == 'week':
+            return (days + 3) // 7
+        return months(days)
+
+    origin = numpy.asarray(origin, dtype=numpy.int64)
+
+    if bucket == 'day':
+        return days - origin
+    if bucket == 'week':
+        return (days - origin) // 7
+
+    # Whole months since the origin: the 10th of May starts month 1 of a
+    # project created on the 10th of April, the 9th doesn't.
+    day_of_month = days - months(days).astype('datetime64[M]').astype('datetime64[D]').astype(numpy.int64)
+    origin_day_of_month = origin - months(origin).astype('datetime64[M]').astype('datetime64[D]').astype(numpy.int64)
+    return months(days) - months(origin) - (day_of_month < origin_day_of_month)
+
+def bucket_label(index, bucket='week', alignment='calendar'):
+    # Calendar buckets are labelled by their first day, relative ones by
+    # their number.
+    if alignment == 'relative':
+        return str(index)
+    if bucket == 'month':
+        return str(numpy.datetime64(int(index), 'M').astype('datetime64[D]'))
+    if bucket == 'week':
+        return str(EPOCH + timedelta(days=int(index) * 7 - 3))
+    return str(EPOCH + timedelta(days=int(index)))
+
+def save_entries(filename, entries):
+    numpy.savez_compressed(filename, **entries)
+
+def load_entries(filename):
+    with numpy.load(filename) as data:
+        return dict((name, data[name]) for name in data.files)
+
+def inflow_matrix(entries, bucket='week', alignment='calendar'):
+    # Builds the cumulative inflow of every project from the entries saved
+    # by NewcomersInflow (newcomers.npz), at any resolution. Returns the
+    # projects, the bucket numbers (columns) and the matrix.
+    if alignment not in ALIGNMENTS:
+        raise ValueError('Unknown alignment: ' + str(alignment))
+
+    projects = entries['projects'].tolist()
+    rows = numpy.repeat(numpy.arange(len(projects)), numpy.diff(entries['pointers']))
+    days = entries['days'].astype(numpy.int64)
+    counts = entries['counts']
+
+    if len(days) == 0:
+        return projects, numpy.zeros(0, dtype=numpy.int64), numpy.zeros((len(projects), 0), dtype=numpy.int64)
+
+    if alignment == 'calendar':
+        keep = days >= entries['created'].max()
+        indices = bucket_indices(days[keep], bucket)
+    else:
+        # Projects are observed from their creation to the last day of the
+        # entries, so the youngest one has the fewest buckets. Later buckets
+        # are dropped: the older projects would otherwise be compared with
+        # the final total of the younger ones, repeated up to their age.
+        horizon = int(bucket_indices(days.max(), bucket, entries['created']).min()) + 1
+        origins = entries['created'][rows]
+        indices = bucket_indices(days, bucket, origins)
+        keep = (days >= origins) & (indices < horizon)
+        indices = indices[keep]
+
+    rows = rows[keep]
+    counts = counts[keep]
+
+    if len(indices) == 0:
+        return projects, numpy.zeros(0, dtype=numpy.int64), numpy.zeros((len(projects), 0), dtype=numpy.int64)
+
+    # Relative series start at bucket 0, the creation of each project, even
+    # when no project had a newcomer in it, and end at the horizon.
+    if alignment == 'calendar':
+        first = indices.min()
+        number_of_buckets = int(indices.max() - first + 1)
+    else:
+        first = 0
+        number_of_buckets = horizon
+    cells = rows * number_of_buckets + (indices - first)
+    inflow = numpy.bincount(cells, weights=counts, minlength=len(projects) * number_of_buckets)
+    inflow = numpy.cumsum(inflow.reshape(len(projects), number_of_buckets), axis=1).astype(numpy.int64)
+
+    return projects, numpy.arange(first, first + number_of_buckets), inflow
+
+def save_inflow(filename, projects, buckets, inflow, bucket='week', alignment='calendar'):
+    numpy.savez_compressed(filename, projects=numpy.array(projects), buckets=buckets, inflow=inflow, bucket=bucket, alignment=alignment)
+
+def load_inflow(filename):
+    # Returns the projects, bucket numbers, matrix, bucket size and alignment.
+    with numpy.load(filename) as data:
+        return data['projects'].tolist(), data['buckets'], data['inflow'], str(data['bucket']), str(data['alignment'])
+
+def project_entries(folder, identity='name', casefold=False):
+    # Days (since the epoch) on which newcomers made their first commit, and
+    # how many of them did, sorted by day.
+    project_events = events.load(folder)
+    authors, names = events.commit_authors(project_events, identity, casefold)
+    ids, first_days = newcomers.first_days(authors, project_events.get('commit_days', authors))
+    days, counts = numpy.unique(first_days, return_counts=True)
+    return days.astype(numpy.int32), counts.astype(numpy.int32)
 
 class NewcomersInflow():
-    def __init__(self, projects, csv_folder, dataset_folder):
+    def __init__(self, projects, csv_folder, dataset_folder, identity='name', casefold=False, bucket='week', alignment='calendar', processes=None, cache=None):
         self.csv_folder = csv_folder
         self.dataset_folder = dataset_folder
+        # How commit authors are told apart, see newcomers.IDENTITIES.
+        self.identity = identity
+        self.casefold = casefold
+        # Number of processes reading the projects, None for one per core.
+        self.processes = processes
+        # Optional stages.StageCache: the stage is skipped when neither the
+        # commits nor the parameters changed, and otherwise only the projects
+        # whose commits changed are read again.
+        self.cache = cache
+
+        outputs = [self.csv_folder + '/newcomers.npz', self.csv_folder + '/inflow.npz', self.csv_folder + '/inflow.csv']
+
+        if self.cache is not None:
+            repositories = [(language, repository['full_name'], repository['created_at']) for language in projects.keys() for repository in projects[language]['items']]
+            commits = [storage.find(self.project_folder(language, repository), 'commits') for language in projects.keys() for repository in projects[language]['items']]
+            parameters = {'projects': repositories, 'identity': identity, 'casefold': casefold, 'bucket': bucket, 'alignment': alignment}
+            key = self.cache.key('inflow', commits, parameters, CODE)
+
+            if self.cache.fresh('inflow', key, outputs):
+                print('The newcomers inflow is up to date. Skipping.')
+                return
+
+        # The first commit day of every newcomer is kept in newcomers.npz,
+        # the inflow can then be computed again at other resolutions (see
+        # inflow_matrix) without reading the commits.
+        entries = self.get_entries(projects)
+        save_entries(self.csv_folder + '/newcomers.npz', entries)
+
+        names, buckets, inflow = inflow_matrix(entries, bucket, alignment)
+        self.export_newcomers_inflow(names, buckets, inflow, bucket, alignment)
+
+        if self.cache is not None:
+            self.cache.record('inflow', key, outputs)
 
-        projects_created_at = []
+    def project_folder(self, language, repository):
+        return self.dataset_folder + '/' + language + '/' + repository['name']
+
+    def get_entries(self, projects):
+        # Entries of all the projects, one after the other: the entries of
+        # project i are days[pointers[i]:pointers[i + 1]] (and their counts).
+        # Projects are read in a pool of processes, each one returning two
+        # small arrays that are concatenated here in the order of projects.json.
+        names = []
+        created = []
+        folders = []
 
         for language in projects.keys():
             repositories = projects[language]['items']
 
             for repository in repositories:
                 created_at = datetime.strptime(repository['created_at'], '%Y-%m-%dT%H:%M:%SZ').date()
-                projects_created_at.append(created_at)
+                names.append(repository['full_name'])
+                created.append(epoch_days(created_at))
+                folders.append(self.project_folder(language, repository))
 
-        self.latest_created_at = max(projects_created_at)
-        weekly_series = self.get_weekly_series(projects)
-        weekly_min, weekly_max = self.get_number_of_weeks(weekly_series)        
-        self.export_newcomers_inflow(weekly_series, weekly_min, weekly_max)
+        function = partial(project_entries, identity=self.identity, casefold=self.casefold)
+        results = [None] * len(folders)
+        keys = [None] * len(folders)
 
-    def get_weekly_series(self, projects):
-        weekly_series = {}
+        if self.cache is not None:
+            for index, folder in enumerate(folders):
+                keys[index] = self.cache.key('newcomers', [storage.find(folder, 'commits')], {'identity': self.identity, 'casefold': self.casefold}, CODE)
+                cached = self.cache.load('newcomers', keys[index])
+                if cached is not None:
+                    results[index] = (cached['days'], cached['counts'])
 
-        for language in projects.keys():
-            repositories = projects[language]['items']
+        pending = [index for index in range(len(folders)) if results[index] is None]
+
+        if self.processes == 1 or not pending:
+            computed = [function(folders[index]) for index in pending]
+        else:
+            with multiprocessing.Pool(processes=self.processes) as parallel:
+                computed = parallel.map(function, [folders[index] for index in pending], chunksize=1)
+
+        for index, result in zip(pending, computed):
+            results[index] = result
+            if self.cache is not None:
+                self.cache.save('newcomers', keys[index], {'days': result[0], 'counts': result[1]})
+
+        days = [project_days for project_days, project_counts in results]
+        counts = [project_counts for project_days, project_counts in results]
+        pointers = numpy.concatenate([[0], numpy.cumsum([len(project_days) for project_days in days])])
+
+        return {'projects': numpy.array(names),
+                'created': numpy.array(created, dtype=numpy.int64),
+                'pointers': pointers.astype(numpy.int64),
+                'days': numpy.concatenate(days + [numpy.zeros(0, dtype=numpy.int32)]).astype(numpy.int32),
+                'counts': numpy.concatenate(counts + [numpy.zeros(0, dtype=numpy.int32)]).astype(numpy.int32)}
+
+    def export_newcomers_inflow(self, projects, buckets, inflow, bucket='week', alignment='calendar'):
+        # inflow.npz holds the matrix itself, inflow.csv the same numbers with
+        # the first day of each bucket (or its number) as the header.
+        save_inflow(self.csv_folder + '/inflow.npz', projects, buckets, inflow, bucket, alignment)
 
-            for repository in repositories:
-                project_folder = self.dataset_folder + '/' + language + '/' + repository['name']
-                project_weekly_series = self.get_project_weekly_series(project_folder)
-                weekly_series[repository['full_name']] = project_weekly_series
-
-        return weekly_series
-
-    def get_project_weekly_series(self, folder):
-        commits_file = json.load(open(folder + '/commits.json', 'r'))
-        newcomers_list = []
-        entry_list = []
-
-        for line in commits_file:
-            newcomer = line['commit']['author']['name']
-            commit_date = line['commit']['author']['date']
-
-            if commit_date is not None:
-                if newcomer is not None:
-                    commit_date = datetime.strptime(commit_date, '%Y-%m-%dT%H:%M:%SZ').date()
-                    
-                    if commit_date >= self.latest_created_at:
-                        if newcomer not in newcomers_list:
-                            newcomers_list.append(newcomer)
-                            entry_list.append(commit_date)
-
-        ordered_entry_list = Counter(entry_list)
-
-        return ordered_entry_list
-
-    def get_number_of_weeks(self, weekly_series):
-        weekly_max = None
-        weekly_min = None
-
-        for series in weekly_series.values():
-            if series:
-                if weekly_min is not None:
-                    if min(series) < weekly_min:
-                        weekly_min = min(series)
-                else:
-                    weekly_min = min(series)
-
-                if weekly_max is not None:
-                    if max(series) > weekly_max:
-                        weekly_max = max(series)
-                else:
-                    weekly_max = max(series)
-
-        return weekly_min, weekly_max
-
-    def export_newcomers_inflow(self, weekly_series, weekly_min, weekly_max):
-        fieldnames = []
-        step = timedelta(days=1)
-
-        while weekly_min <= weekly_max:
-            week = (weekly_min.isocalendar()[1], weekly_min.year)
-            if not week in fieldnames:
-                fieldnames.append(week)
-            weekly_min += step
-        
         with open(self.csv_folder + '/inflow.csv', 'w') as inflow_file:
-            writer = csv.DictWriter(inflow_file, fieldnames=['project'] + fieldnames)
-            writer.writeheader()
-        
-        for project in weekly_series:
-            inflow = {}
-            inflow['project'] = project
-            number_of_newcomers = 0
-
-            for week in fieldnames:
-                for entry_date in weekly_series[project]:
-                    entry_date = (entry_date.isocalendar()[1], entry_date.year)
-                    if entry_date == week:
-                        number_of_newcomers = number_of_newcomers + 1
-                inflow[week] = number_of_newcomers
-
-            with open(self.csv_folder + '/inflow.csv', 'a') as inflow_file:
-                writer = csv.DictWriter(inflow_file, fieldnames=['project'] + fieldnames)
-                writer.writerow(inflow)
+            writer = csv.writer(inflow_file)
+            writer.writerow(['project'] + [bucket_label(index, bucket, alignment) for index in buckets])
+            writer.writerows([project] + row for project, row in zip(projects, inflow.tolist()))
 
 if __name__ == '__main__':
     dataset_folder = '../dataset'
@@ -123,4 +260,18 @@ if __name__ == '__main__':
         with open(dataset_folder + '/projects.json', 'r') as projects_file:
             projects = json.load(projects_file)
 
-    inflow = NewcomersInflow(projects, csv_folder, dataset_folder)
\ No newline at end of file
+    # How commit authors are told apart: 'name' (as in the study), 'email'
+    # or 'login', optionally ignoring case and surrounding spaces.
+    identity = 'name'
+    casefold = False
+    # Resolution of the series ('day', 'week' or 'month') and whether the
+    # projects share the same calendar ('calendar') or start on the day they
+    # were created ('relative').
+    bucket = 'week'
+    alignment = 'calendar'
+    # Number of processes reading the projects, None for one per core.
+    processes = None
+    # Results of previous runs, see stages.py.
+    cache = stages.StageCache(csv_folder + '/.stages')
+
+    inflow = NewcomersInflow(projects, csv_folder, dataset_folder, identity, casefold, bucket, alignment, processes, cache)
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ =  'Felipe Fronchetti'
+__contact__ = 'fronchetti@usp.br'
+
+import numpy
+import events
+
+# Ways of telling commit authors apart, see events.IDENTITIES.
+IDENTITIES = events.IDENTITIES
+
+def first_days(authors, days):
+    # First commit of every author, over the columns of events.npz: author
+    # ids (-1 when unknown) and days (events.MISSING when unknown). Returns
+    # the ids of the authors and the day of their first commit.
+    known = (authors >= 0) & (days != events.MISSING)
+    authors = authors[known]
+    days = days[known]
+    order = numpy.lexsort((days, authors))
+    ids, first = numpy.unique(authors[order], return_index=True)
+    return ids, days[order][first]
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ =  'Felipe Fronchetti'
+__contact__ = 'fronchetti@usp.br'
+
+import os
+import json
+import numpy
+import hashlib
+
+class StageCache():
+    # Cache of the analysis stages (inflow -> cluster -> classifier, and
+    # summary). A stage is keyed by the content of its input files, its
+    # parameters and its code: when none changed and its outputs are still the ones it
+    # wrote, the stage is skipped. Per-project results are stored under their
+    # own keys, so only the projects whose files changed are computed again.
+
+    def __init__(self, folder):
+        self.folder = folder
+        # Hashes of the files already read, reused while their size and
+        # modification time don't change.
+        self.index_filename = os.path.join(folder, 'files.json')
+        self.index = {}
+        self.index_changed = False
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+
+        if os.path.isfile(self.index_filename):
+            with open(self.index_filename, 'r') as index_file:
+                self.index = json.load(index_file)
+
+    def file_digest(self, path):
+        if path is None or not os.path.isfile(path):
+            return None
+
+        status = os.stat(path)
+        path = os.path.abspath(path)
+        entry = self.index.get(path)
+
+        if entry is not None and entry[0] == status.st_size and entry[1] == status.st_mtime_ns:
+            return entry[2]
+
+        content = hashlib.sha1()
+        with open(path, 'rb') as content_file:
+            for block in iter(lambda: content_file.read(1024 * 1024), b''):
+                content.update(block)
+
+        self.index[path] = [status.st_size, status.st_mtime_ns, content.hexdigest()]
+        self.index_changed = True
+        return content.hexdigest()
+
+    def key(self, stage, inputs=[], parameters={}, code=[]):
+        # Inputs are file paths (None for a missing file), parameters must be
+        # JSON serializable. code lists the source files of the modules that
+        # compute the stage (e.g. [__file__, events.__file__]): a stage whose
+        # code changed is computed again, as one whose inputs changed.
+        content = json.dumps([stage, [self.file_digest(path) for path in inputs], parameters, [self.file_digest(path) for path in code]], sort_keys=True, default=str)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def save_index(self):
+        if self.index_changed:
+            temporary = self.index_filename + '.' + str(os.getpid()) + '.tmp'
+            with open(temporary, 'w') as index_file:
+                json.dump(self.index, index_file)
+            os.replace(temporary, self.index_filename)
+            self.index_changed = False
+
+    # Whole stages.
+
+    def fresh(self, stage, key, outputs):
+        # True when the stage already ran with this key and its outputs are
+        # untouched since then.
+        filename = os.path.join(self.folder, stage + '.json')
+
+        if not os.path.isfile(filename):
+            return False
+
+        with open(filename, 'r') as stage_file:
+            record = json.load(stage_file)
+
+        if record['key'] != key or sorted(record['outputs']) != sorted(os.path.abspath(output) for output in outputs):
+            return False
+
+        return all(self.file_digest(output) == digest for output, digest in record['outputs'].items())
+
+    def record(self, stage, key, outputs):
+        record = {'key': key, 'outputs': dict((os.path.abspath(output), self.file_digest(output)) for output in outputs)}
+
+        with open(os.path.join(self.folder, stage + '.json'), 'w') as stage_file:
+            json.dump(record, stage_file)
+
+        self.save_index()
+
+    # Per-project results.
+
+    def filename(self, stage, key, extension):
+        return os.path.join(self.folder, stage, key[:2], key + extension)
+
+    def load(self, stage, key):
+        # Arrays stored by save (None when there are none for this key).
+        filename = self.filename(stage, key, '.npz')
+
+        if not os.path.isfile(filename):
+            return None
+
+        with numpy.load(filename) as data:
+            return dict((name, data[name]) for name in data.files)
+
+    def save(self, stage, key, arrays):
+        filename = self.filename(stage, key, '.npz')
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temporary = filename[:-len('.npz')] + '.' + str(os.getpid()) + '.tmp.npz'
+        numpy.savez_compressed(temporary, **arrays)
+        os.replace(temporary, filename)
+
+    def load_json(self, stage, key):
+        filename = self.filename(stage, key, '.json')
+
+        if not os.path.isfile(filename):
+            return None
+
+        with open(filename, 'r') as result_file:
+            return json.load(result_file)
+
+    def save_json(self, stage, key, result):
+        filename = self.filename(stage, key, '.json')
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temporary = filename + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary, 'w') as result_file:
+            json.dump(result, result_file, default=str)
+        os.replace(temporary, filename)
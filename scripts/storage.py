@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ =  'Felipe Fronchetti'
+__contact__ = 'fronchetti@usp.br'
+
+import os
+import gzip
+import json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Ways a resource (commits, stars, forks, pull_requests...) can be stored in
+# a project folder. 'json' is a single list, the others have one record per
+# line (JSON Lines), optionally compressed.
+FORMATS = ['json', 'jsonl', 'jsonl.gz', 'jsonl.zst']
+
+def filename(folder, resource, storage='json'):
+    if storage not in FORMATS:
+        raise ValueError('Unknown storage format: ' + str(storage))
+    return folder + '/' + resource + '.' + storage
+
+def find(folder, resource):
+    # Returns the file holding the resource, whatever its format (or None).
+    for storage in FORMATS:
+        if os.path.isfile(filename(folder, resource, storage)):
+            return filename(folder, resource, storage)
+    return None
+
+def exists(folder, resource):
+    return find(folder, resource) is not None
+
+def open_file(path, mode='r'):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('The zstandard package is required to read or write ' + path)
+        return zstandard.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode)
+
+def records(folder, resource):
+    # Yields the records of a resource one by one. JSON Lines files are read
+    # line by line, plain JSON files have to be loaded at once.
+    path = find(folder, resource)
+
+    if path is None:
+        raise IOError('There is no ' + resource + ' file in ' + folder)
+
+    with open_file(path, 'r') as resource_file:
+        if path.endswith('.json'):
+            for record in json.load(resource_file):
+                yield record
+        else:
+            for line in resource_file:
+                if line.strip():
+                    yield json.loads(line)
+
+def field(record, path):
+    # Reads a nested field of a record such as 'commit.author.date' (None if
+    # missing).
+    for key in path.split('.'):
+        if not isinstance(record, dict):
+            return None
+        record = record.get(key)
+    return record
+
+def remove(folder, resource, keep=None):
+    for storage in FORMATS:
+        path = filename(folder, resource, storage)
+        if path != keep and os.path.isfile(path):
+            os.remove(path)
+
+class RecordWriter():
+    # Writes records as they arrive to a partial file, which replaces the
+    # resource (in any previous format) once it is closed. A resource file
+    # therefore always holds a complete listing.
+
+    def __init__(self, folder, resource, storage='json'):
+        self.folder = folder
+        self.resource = resource
+        self.filename = filename(folder, resource, storage)
+        self.partial = folder + '/partial.' + resource + '.' + storage
+        self.json = storage == 'json'
+        self.count = 0
+        self.file = open_file(self.partial, 'w')
+
+        if self.json:
+            self.file.write('[')
+
+    def write(self, record):
+        if self.json:
+            if self.count > 0:
+                self.file.write(', ')
+            json.dump(record, self.file)
+        else:
+            self.file.write(json.dumps(record) + '\n')
+
+        self.count = self.count + 1
+
+    def close(self):
+        if self.json:
+            self.file.write(']')
+
+        self.file.close()
+        os.replace(self.partial, self.filename)
+        remove(self.folder, self.resource, keep=self.filename)
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.partial)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is None:
+            self.close()
+        else:
+            self.discard()
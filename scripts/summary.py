@@ -6,132 +6,117 @@ __contact__ = 'fronchetti@usp.br'
 
 import os
 import csv
+import multiprocessing
+from functools import partial
 import json
 import numpy
-from datetime import timedelta
+import events
+import stages
+import storage
+import newcomers
+from datetime import date, timedelta
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
-class Summary():
-    def __init__(self, repository, folder):
-        self.folder = folder
-        self.domains = {}
-
-        with open('../tables/domains.csv', 'r') as domains_file:
-            domains = csv.DictReader(domains_file)
+# Source files the summary rows depend on, see stages.StageCache.key.
+CODE = [__file__, events.__file__, newcomers.__file__, storage.__file__]
 
-            for domain in domains:
-                self.domains[domain['name']] = domain['domain']
+def load_domains(filename='../tables/domains.csv'):
+    domains = {}
 
-    def get_time_for_merge(self):
-        pull_requests_file = json.load(open(self.folder + '/pull_requests.json', 'r'))
-        time_for_merge = []
+    with open(filename, 'r') as domains_file:
+        for domain in csv.DictReader(domains_file):
+            domains[domain['name']] = domain['domain']
 
-        for line in pull_requests_file:
-            merged_date =  line['merged_at']
-            created_date = line['created_at']
+    return domains
 
-            if merged_date is not None:
-                merged_date = datetime.strptime(merged_date, '%Y-%m-%dT%H:%M:%SZ').date()
-                created_date = datetime.strptime(created_date, '%Y-%m-%dT%H:%M:%SZ').date()
-                delta = merged_date - created_date
-                interval = delta.days
-                time_for_merge.append(interval)
+class Summary():
+    def __init__(self, repository, folder, identity='name', casefold=False, domains=None):
+        self.repository = repository
+        self.folder = folder
+        # How commit authors are told apart, see newcomers.IDENTITIES.
+        self.identity = identity
+        self.casefold = casefold
+        # Files of the project, each one parsed once (on first use).
+        self.documents = {}
+        self.events = None
+        self.authors = None
+
+        # Pass the domains (see load_domains) to share them between projects.
+        if domains is None:
+            domains = load_domains()
+        self.domains = domains
+
+    def document(self, name):
+        # Contents of about.json, languages.json or metrics.json.
+        if name not in self.documents:
+            with open(self.folder + '/' + name + '.json', 'r') as document_file:
+                self.documents[name] = json.load(document_file)
+        return self.documents[name]
+
+    def get_events(self):
+        # Columns of events.npz (see events.py), loaded once per project.
+        if self.events is None:
+            self.events = events.load(self.folder)
+        return self.events
+
+    def get_commit_authors(self):
+        # Author of each commit and the table of authors, shared by the
+        # newcomers and the contributors.
+        if self.authors is None:
+            self.authors = events.commit_authors(self.get_events(), self.identity, self.casefold)
+        return self.authors
 
-        return time_for_merge
+    def get_time_for_merge(self):
+        project_events = self.get_events()
+        created = project_events['pull_request_created']
+        merged = project_events['pull_request_merged']
+        time_for_merge = merged[merged != events.MISSING] - created[merged != events.MISSING]
+        return time_for_merge.tolist()
 
     def get_integrators(self):
-        pull_requests_file = json.load(open(self.folder + '/pull_requests.json', 'r'))
-        integrators = []
-
-        for line in pull_requests_file:
-            if 'merged_by' in line:
-                merged_by = line['merged_by']
-
-                if merged_by is not None:
-                    if 'login' in line['merged_by']:
-                        integrator = line['merged_by']['login']
-                    else:
-                        integrator = 'Anonymous'
-                    
-                    if core_member not in integrators:
-                        integrators.append(integrator)
-
-        return integrators
+        project_events = self.get_events()
+        integrators = numpy.unique(project_events['pull_request_integrators'])
+        logins = project_events['logins']
+        return sorted(logins[integrators[integrators >= 0]].tolist())
 
     def get_newcomers(self):
-        commits_file = json.load(open(self.folder + '/commits.json', 'r'))
-        newcomers_list = []
+        project_events = self.get_events()
 
-        about_file = json.load(open(self.folder + '/about.json', 'r'))
+        about_file = self.document('about')
         created_at = datetime.strptime(about_file['created_at'], '%Y-%m-%dT%H:%M:%SZ') + relativedelta(months=6)
+        created_at = (created_at.date() - date(1970, 1, 1)).days
 
-        for line in commits_file:
-            newcomer = line['commit']['author']['name']
-            commit_date = line['commit']['author']['date']
-
-            if commit_date is not None:
-                if newcomer is not None:
-                    commit_date = datetime.strptime(commit_date, '%Y-%m-%dT%H:%M:%SZ').date()
-
-                    if commit_date >= created_at.date():
-                        if newcomer not in newcomers_list:
-                            newcomers_list.append(newcomer)
-
-        return newcomers_list
+        # Authors whose first commit came after the first six months.
+        authors, names = self.get_commit_authors()
+        ids, first_days = newcomers.first_days(authors, project_events.get('commit_days', authors))
+        return sorted(names[author] for author in ids[first_days >= created_at].tolist())
 
     def get_contributors(self):
-        commits_file = json.load(open(self.folder + '/commits.json', 'r'))
-        contributors_list = []
-
-        for line in commits_file:
-            contributor = line['commit']['author']['name']
-
-            if contributor is not None:
-                if contributor not in contributors_list:
-                    contributors_list.append(contributor)
-
-        return contributors_list        
+        authors, names = self.get_commit_authors()
+        return sorted(names[author] for author in numpy.unique(authors[authors >= 0]).tolist())
 
     def get_stars(self):
-        stars_file = json.load(open(self.folder + '/stars.json', 'r'))
-        stars_list = []
-
-        for line in stars_file:
-            star_date = line['starred_at']
-
-            if star_date is not None:
-                star_date = datetime.strptime(star_date, '%Y-%m-%dT%H:%M:%SZ').date()
-                stars_list.append(star_date)
-
-        return stars_list
+        star_days = self.get_events()['star_days']
+        return star_days[star_days != events.MISSING]
 
     def get_forks(self):
-        forks_file = json.load(open(self.folder + '/forks.json', 'r'))
-        forks_list = []
-
-        for line in forks_file:
-            fork_date = line['created_at']
-
-            if fork_date is not None:
-                fork_date = datetime.strptime(fork_date, '%Y-%m-%dT%H:%M:%SZ').date()
-                forks_list.append(fork_date)
-
-        return forks_list
+        fork_days = self.get_events()['fork_days']
+        return fork_days[fork_days != events.MISSING]
 
     def get_domain(self):
-        if repository['full_name'] in self.domains.keys():
-            domain = self.domains[repository['full_name']]
+        if self.repository['full_name'] in self.domains.keys():
+            domain = self.domains[self.repository['full_name']]
         else:
             domain = 'Undefined'
         return domain
 
     def get_used_languages(self):
-        used_languages = json.load(open(self.folder + '/languages.json', 'r'))
+        used_languages = self.document('languages')
         return used_languages
 
     def has_readme(self):
-        metrics = json.load(open(self.folder + '/metrics.json', 'r'))
+        metrics = self.document('metrics')
 
         if metrics['files']['readme'] is not None:
             return True
@@ -139,7 +124,7 @@ class Summary():
             return False
 
     def has_contributing(self):
-        metrics = json.load(open(self.folder + '/metrics.json', 'r'))
+        metrics = self.document('metrics')
 
         if metrics['files']['contributing'] is not None:
             return True
@@ -147,7 +132,7 @@ class Summary():
             return False
 
     def has_code_of_conduct(self):
-        metrics = json.load(open(self.folder + '/metrics.json', 'r'))
+        metrics = self.document('metrics')
 
         if metrics['files']['code_of_conduct'] is not None:
             return True
@@ -155,7 +140,7 @@ class Summary():
             return False
 
     def has_license(self):
-        metrics = json.load(open(self.folder + '/metrics.json', 'r'))
+        metrics = self.document('metrics')
 
         if metrics['files']['license'] is not None:
             return True
@@ -163,7 +148,7 @@ class Summary():
             return False
 
     def has_pull_request_template(self):
-        metrics = json.load(open(self.folder + '/metrics.json', 'r'))
+        metrics = self.document('metrics')
 
         if metrics['files']['pull_request_template'] is not None:
             return True
@@ -171,7 +156,7 @@ class Summary():
             return False
 
     def has_issue_template(self):
-        metrics = json.load(open(self.folder + '/metrics.json', 'r'))
+        metrics = self.document('metrics')
 
         if metrics['files']['issue_template'] is not None:
             return True
@@ -179,9 +164,158 @@ class Summary():
             return False
 
     def has_wiki(self):
-        about_file = json.load(open(self.folder + '/about.json', 'r'))
+        about_file = self.document('about')
         return about_file['has_wiki']
 
+FIELDNAMES = ['name',
+              'owner',
+              'created_at',
+              'github_url',
+              'stars',
+              'forks',
+              'has_contributing',
+              'has_readme',
+              'has_code_of_conduct',
+              'has_pull_request_template',
+              'has_issue_template',
+              'has_wiki',
+              'has_license',
+              'languages',
+              'age',
+              'domain',
+              'main_language',
+              'owner_type',
+              'newcomers',
+              'contributors',
+              'integrators',
+              'time_for_merge']
+
+def summary_row(task, identity='name', casefold=False, domains={}):
+    # Row of summary.csv of a project. Returns (name, row, error), failures
+    # are returned rather than raised so the other projects are not lost.
+    repository, project_folder = task
+
+    try:
+        project = Summary(repository, project_folder, identity, casefold, domains)
+
+        created_at = datetime.strptime(repository['created_at'], '%Y-%m-%dT%H:%M:%SZ').date()
+        star_total = project.get_stars()
+        fork_total = project.get_forks()
+        used_languages = project.get_used_languages()
+        has_contributing = project.has_contributing()
+        has_readme = project.has_readme()
+        has_code_of_conduct = project.has_code_of_conduct()
+        has_pull_request_template = project.has_pull_request_template()
+        has_issue_template = project.has_issue_template()
+        has_wiki = project.has_wiki()
+        has_license = project.has_license()
+        owner_type = repository['owner']['type']
+        main_language = repository['language']
+        age = 2018 - int(created_at.year)
+        application_domain = project.get_domain()
+        project_newcomers = project.get_newcomers()
+        contributors = project.get_contributors()
+        integrators = project.get_integrators()
+        time_for_merge = project.get_time_for_merge()
+
+        data = {'name': repository['full_name'],
+                'owner': repository['owner']['login'],
+                'created_at': created_at,
+                'github_url': repository['html_url'],
+                'stars': len(numpy.nan_to_num(star_total)),
+                'forks': len(numpy.nan_to_num(fork_total)),
+                'has_contributing': has_contributing,
+                'has_readme': has_readme,
+                'has_code_of_conduct': has_code_of_conduct,
+                'has_pull_request_template': has_pull_request_template,
+                'has_issue_template': has_issue_template,
+                'has_wiki': has_wiki,
+                'has_license': has_license,
+                'languages': len(used_languages),
+                'age': age,
+                'domain': application_domain,
+                'main_language': main_language,
+                'owner_type': owner_type,
+                'newcomers': len(numpy.nan_to_num(project_newcomers)),
+                'contributors': len(numpy.nan_to_num(contributors)),
+                'integrators': len(numpy.nan_to_num(integrators)),
+                'time_for_merge': int(numpy.nan_to_num(numpy.average(time_for_merge))) if len(time_for_merge) else 0}
+
+        return repository['full_name'], data, None
+    except Exception as error:
+        return repository['full_name'], None, repr(error)
+
+def project_files(project_folder):
+    # Files a row of summary.csv is computed from.
+    files = [project_folder + '/' + name + '.json' for name in ['about', 'languages', 'metrics']]
+    return files + [storage.find(project_folder, resource) for resource in events.SOURCES]
+
+def export_summary(projects, dataset_folder, csv_folder, identity='name', casefold=False, processes=None, cache=None):
+    # Computes the rows in a pool of processes (one per core by default, 1
+    # to compute them here) and writes summary.csv at once, in the order of
+    # projects.json. Returns the projects that failed. With a
+    # stages.StageCache, only the rows of the projects whose files changed
+    # are computed again.
+    domains = load_domains(csv_folder + '/domains.csv')
+    tasks = []
+
+    for language in projects.keys():
+        for repository in projects[language]['items']:
+            tasks.append((repository, dataset_folder + '/' + language + '/' + repository['name']))
+
+    function = partial(summary_row, identity=identity, casefold=casefold, domains=domains)
+    results = [None] * len(tasks)
+    keys = [None] * len(tasks)
+    outputs = [csv_folder + '/summary.csv']
+
+    if cache is not None:
+        for index, (repository, project_folder) in enumerate(tasks):
+            parameters = {'repository': repository, 'identity': identity, 'casefold': casefold, 'domain': domains.get(repository['full_name'])}
+            keys[index] = cache.key('summary_row', project_files(project_folder), parameters, CODE)
+
+        key = cache.key('summary', [], keys, CODE)
+
+        if cache.fresh('summary', key, outputs):
+            print('The summary is up to date. Skipping.')
+            return []
+
+        for index in range(len(tasks)):
+            row = cache.load_json('summary_row', keys[index])
+            if row is not None:
+                results[index] = (tasks[index][0]['full_name'], row, None)
+
+    pending = [index for index in range(len(tasks)) if results[index] is None]
+
+    if processes == 1 or not pending:
+        computed = [function(tasks[index]) for index in pending]
+    else:
+        with multiprocessing.Pool(processes=processes) as parallel:
+            computed = parallel.map(function, [tasks[index] for index in pending], chunksize=1)
+
+    for index, result in zip(pending, computed):
+        results[index] = result
+        # Failed rows are not cached, they are tried again on the next run.
+        if cache is not None and result[2] is None:
+            cache.save_json('summary_row', keys[index], result[1])
+
+    failures = []
+
+    with open(csv_folder + '/summary.csv', 'w') as summary_file:
+        writer = csv.DictWriter(summary_file, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(data for name, data, error in results if data is not None)
+
+    for name, data, error in results:
+        if error is not None:
+            print('Failed to summarize ' + name + ': ' + error)
+            failures.append(name)
+
+    # A summary with failed rows is never considered up to date.
+    if cache is not None and not failures:
+        cache.record('summary', key, outputs)
+
+    return failures
+
 if __name__ == '__main__':
     dataset_folder = '../dataset'
     csv_folder = '../tables'
@@ -190,83 +324,14 @@ if __name__ == '__main__':
         with open(dataset_folder + '/projects.json', 'r') as projects_file:
             projects = json.load(projects_file)
 
-    fieldnames = ['name',
-                  'owner',
-                  'created_at',
-                  'github_url',
-                  'stars',
-                  'forks',
-                  'has_contributing',
-                  'has_readme',
-                  'has_code_of_conduct',
-                  'has_pull_request_template',
-                  'has_issue_template',
-                  'has_wiki',
-                  'has_license',
-                  'languages',
-                  'age',
-                  'domain',
-                  'main_language',
-                  'owner_type',
-                  'newcomers',
-                  'contributors',
-                  'integrators',
-                  'time_for_merge']
-
-    with open(csv_folder + '/summary.csv', 'w') as summary_file:
-        writer = csv.DictWriter(summary_file, fieldnames=fieldnames)
-        writer.writeheader()
-
-    for language in projects.keys():
-        repositories = projects[language]['items']
-
-        for repository in repositories:
-            project_folder = dataset_folder + '/' + language + '/' + repository['name']
-            project = Summary(repository, project_folder)
-
-            created_at = datetime.strptime(repository['created_at'], '%Y-%m-%dT%H:%M:%SZ').date()
-            star_total = project.get_stars()
-            fork_total = project.get_forks()
-            used_languages = project.get_used_languages()
-            has_contributing = project.has_contributing()
-            has_readme = project.has_readme()
-            has_code_of_conduct = project.has_code_of_conduct()
-            has_pull_request_template = project.has_pull_request_template()
-            has_issue_template = project.has_issue_template()
-            has_wiki = project.has_wiki()
-            has_license = project.has_license()
-            owner_type = repository['owner']['type']
-            main_language = repository['language']
-            age = 2018 - int(created_at.year)
-            application_domain = project.get_domain()
-            newcomers = project.get_newcomers()
-            contributors = project.get_contributors()
-            integrators = project.get_integrators()
-            time_for_merge = project.get_time_for_merge()
-
-            with open(csv_folder + '/summary.csv', 'a') as summary_file:
-                writer = csv.DictWriter(summary_file, fieldnames=fieldnames)
-                data = {'name': repository['full_name'],
-                        'owner': repository['owner']['login'],
-                        'created_at': created_at,
-                        'github_url': repository['html_url'],
-                        'stars': len(numpy.nan_to_num(star_total)),
-                        'forks': len(numpy.nan_to_num(fork_total)),
-                        'has_contributing': has_contributing,
-                        'has_readme': has_readme,
-                        'has_code_of_conduct': has_code_of_conduct,
-                        'has_pull_request_template': has_pull_request_template,
-                        'has_issue_template': has_issue_template,
-                        'has_wiki': has_wiki,
-                        'has_license': has_license,
-                        'languages': len(used_languages),
-                        'age': age,
-                        'domain': application_domain,
-                        'main_language': main_language,
-                        'owner_type': owner_type,
-                        'newcomers': len(numpy.nan_to_num(newcomers)),
-                        'contributors': len(numpy.nan_to_num(contributors)),
-                        'integrators': len(numpy.nan_to_num(integrators)),
-                        'time_for_merge': int(numpy.nan_to_num(numpy.average(time_for_merge)))}
-
-                writer.writerow(data)
+    # How commit authors are told apart: 'name' (as in the study), 'email'
+    # or 'login', optionally ignoring case and surrounding spaces.
+    identity = 'name'
+    casefold = False
+    # Number of processes computing the rows, None for one per core.
+    processes = None
+    # Results of previous runs, see stages.py.
+    cache = stages.StageCache(csv_folder + '/.stages')
+
+    failures = export_summary(projects, dataset_folder, csv_folder, identity, casefold, processes, cache)
+    print('Summary finished, ' + str(len(failures)) + ' projects failed.')
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ =  'Felipe Fronchetti'
+__contact__ = 'fronchetti@usp.br'
+
+import time
+import json
+import random
+import asyncio
+import logging
+import aiohttp
+from datetime import datetime
+from telescope.collector import TokenPool, CollectorError, primary_limit, retryable, retry_after, rate_limit_bucket
+from telescope.metrics import endpoint
+
+logger = logging.getLogger(__name__)
+
+class AsyncCollector:
+
+    def __init__(self, client_id=None, client_secret=None, concurrency=100, pool_size=100, api_url='https://api.github.com/', credentials=None, metrics=None, retries=5, backoff=1, max_backoff=64, secondary_wait=60, timeout=60):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
+        if credentials is None:
+            credentials = [(client_id, client_secret)]
+        self.tokens = TokenPool(credentials)
+        self.api_url = api_url
+        # Maximum number of requests in flight at the same time.
+        self.concurrency = concurrency
+        self.pool_size = pool_size
+        self.session = None
+        self.semaphore = None
+        # Optional telescope.metrics.Metrics, see Collector.
+        self.metrics = metrics
+        # Failed requests are retried as in Collector (see its parameters).
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.secondary_wait = secondary_wait
+        self.timeout = timeout
+
+    async def open(self):
+        # aiohttp sessions and asyncio primitives must be created inside
+        # the event loop that is going to use them.
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self.session = aiohttp.ClientSession(connector=connector)
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+        self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *arguments):
+        await self.close()
+
+    async def request(self, path, parameters={}, headers={}, listing=False):
+        content, last_page = await self.page(path, parameters, headers, listing)
+        return content
+
+    async def page(self, path, parameters={}, headers={}, listing=False):
+        # Returns the content of a page and the number of the last page
+        # announced in the Link header (None when there is no rel="last").
+        # Failed requests are retried as in Collector.send, CollectorError is
+        # raised when they still fail, or when a page of a listing isn't a
+        # list (404, 409 for an empty repository...).
+        await self.open()
+        url = self.api_url + path
+        attempt = 0
+
+        while True:
+            wait = None
+            status = None
+
+            async with self.semaphore:
+                token = await self.acquire(rate_limit_bucket(url))
+                request_parameters, request_headers = self.tokens.authenticate(token, parameters, headers)
+
+                try:
+                    logger.debug('Creating request for: ' + url)
+                    started = time.time()
+                    timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+                    async with self.session.get(url, params=request_parameters, headers=request_headers, timeout=timeout) as response:
+                        body = await response.read()
+                        status = response.status
+
+                        if self.metrics is not None:
+                            self.metrics.request(url, status, time.time() - started, len(body))
+
+                        self.verify_rate_limit(response.headers, token, rate_limit_bucket(url, response.headers))
+                        text = body.decode('utf-8')
+
+                        if primary_limit(status, response.headers):
+                            # As in Collector.send, another token (or the reset)
+                            # is used next, and it counts as an attempt.
+                            if self.metrics is not None:
+                                self.metrics.add('rate_limit_exhausted_total', endpoint=endpoint(url))
+                            failure = '[RATE-LIMIT] ' + str(status) + ' ' + url + ' ' + text[:200]
+                            wait = 0
+                        elif not retryable(status, response.headers, text):
+                            content = json.loads(text)
+
+                            if listing and not isinstance(content, list):
+                                raise CollectorError('[HTTP] ' + str(status) + ' ' + url + ' is not a listing: ' + text[:200], url, status)
+
+                            return content, self.last_page(response)
+                        else:
+                            failure = '[HTTP] ' + str(status) + ' ' + url + ' ' + text[:200]
+                            wait = retry_after(status, response.headers, text, self.secondary_wait)
+
+                except ValueError as error:
+                    # Truncated or invalid body.
+                    failure = '[JSON] ' + url + ' ' + str(error)
+                except aiohttp.ClientConnectionError as error:
+                    failure = '[CONNECTION] ' + url + ' ' + str(error)
+                except asyncio.TimeoutError as error:
+                    failure = '[TIMEOUT] ' + url + ' ' + str(error)
+                except aiohttp.ClientError as error:
+                    failure = '[REQUEST] ' + url + ' ' + str(error)
+
+            logger.warning(failure)
+
+            if attempt >= self.retries:
+                if self.metrics is not None:
+                    self.metrics.add('failures_total', endpoint=endpoint(url))
+                raise CollectorError('Request failed after ' + str(attempt + 1) + ' attempts: ' + failure, url, status)
+
+            if wait is None:
+                wait = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+            attempt = attempt + 1
+            logger.info('[API] Request failed, retrying in ' + str(round(wait, 1)) + ' seconds (' + str(attempt) + ' of ' + str(self.retries) + ').')
+
+            if self.metrics is not None:
+                self.metrics.add('retries_total', endpoint=endpoint(url), reason=failure.split(' ')[0].strip('[]').lower())
+                self.metrics.add('retry_wait_seconds_total', wait)
+
+            # Other requests keep running while this one waits.
+            await asyncio.sleep(wait)
+
+    def last_page(self, response):
+        if 'last' in response.links:
+            page = response.links['last']['url'].query.get('page')
+            if page is not None:
+                return int(page)
+        return None
+
+    async def acquire(self, bucket='core'):
+        # Same as TokenPool.acquire, but other requests keep running while
+        # this one waits for a rate limit window to reset.
+        token, wait = self.tokens.choose(bucket)
+
+        while token is None:
+            datetime_format = '%Y-%m-%d %H:%M:%S'
+            reset_time = datetime.fromtimestamp(time.time() + wait).strftime(datetime_format)
+            logger.warning('The request limit of every token is over. The request is waiting until it can be resumed.')
+            logger.warning('The limit will reset on: ' + reset_time)
+            await asyncio.sleep(max(wait, 0) + 1)
+            if self.metrics is not None:
+                self.metrics.add('rate_limit_wait_seconds_total', max(wait, 0) + 1)
+            token, wait = self.tokens.choose(bucket)
+
+        return token
+
+    def verify_rate_limit(self, headers, token=0, bucket='core'):
+        if 'x-ratelimit-remaining' in headers:
+            self.rate_limit_remaining = int(headers['x-ratelimit-remaining'])
+            self.rate_limit_reset = int(headers['x-ratelimit-reset'])
+            self.tokens.update(token, self.rate_limit_remaining, self.rate_limit_reset, bucket)
+
+            logger.debug('[API] Requests Remaining:' + str(self.rate_limit_remaining))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ =  'Felipe Fronchetti'
+__contact__ = 'fronchetti@usp.br'
+
+import asyncio
+import logging
+from telescope.repository import page_window
+
+logger = logging.getLogger(__name__)
+
+class AsyncRepository:
+
+    def __init__(self, organization, name, collector, per_page=100):
+        self.name = name
+        self.organization = organization
+        self.github = collector
+        self.per_page = per_page
+
+    def path(self, resource=''):
+        return 'repos/' + self.organization + '/' + self.name + resource
+
+    async def listing(self, resource, parameters={}, headers={}, page_range={}):
+        items = []
+        parameters = dict(parameters)
+        parameters['per_page'] = self.per_page
+
+        first_page, last_page, skip, remaining = 1, None, 0, None
+
+        if page_range:
+            first_page, last_page, skip, remaining = page_window(page_range, self.per_page)
+
+        if last_page is not None:
+            # The pages are known beforehand, so all of them are requested at once.
+            requests = []
+            for page_number in range(first_page, last_page):
+                page_parameters = dict(parameters)
+                page_parameters['page'] = page_number
+                requests.append(self.github.request(self.path(resource), page_parameters, headers, listing=True))
+
+            for request in await asyncio.gather(*requests):
+                if request:
+                    request = request[skip:skip + remaining]
+                    skip = 0
+                    remaining = remaining - len(request)
+                    items.extend(request)
+        else:
+            # The first page tells how many pages exist (Link header, rel="last"),
+            # the remaining ones are then requested all at once.
+            parameters['page'] = first_page
+            request, last_page = await self.github.page(self.path(resource), parameters, headers, listing=True)
+
+            if request:
+                items.extend(request[skip:])
+
+                if last_page is not None and last_page > first_page:
+                    items.extend(await self.listing(resource, parameters, headers, {'first_page': first_page + 1, 'last_page': last_page + 1, 'per_page': self.per_page}))
+
+        return items
+
+    async def pull_request(self, number):
+        logger.info('[Repository] Returning pull-request #' + str(number) + ' in ' + self.name)
+        return await self.github.request(self.path('/pulls/' + str(number)))
+
+    async def pull_request_reviews(self, number, page_range={}):
+        return await self.listing('/pulls/' + str(number) + '/comments', page_range=page_range)
+
+    async def pull_request_comments(self, number, page_range={}):
+        return await self.listing('/issues/' + str(number) + '/comments', page_range=page_range)
+
+    async def pull_request_details(self, number):
+        pull_request, reviews, comments = await asyncio.gather(self.pull_request(number),
+                                                               self.pull_request_reviews(number),
+                                                               self.pull_request_comments(number))
+        if pull_request:
+            pull_request['reviews'] = reviews
+            pull_request['comments'] = comments
+        return pull_request
+
+    async def commits(self, sha=None, path=None, author=None, since=None, until=None, page_range={}):
+        logger.info('[Repository] Returning commits available in ' + self.name)
+        parameters = {}
+
+        if sha is not None:
+            parameters['sha'] = sha
+        if path is not None:
+            parameters['path'] = path
+        if author is not None:
+            parameters['author'] = author
+        if since is not None:
+            parameters['since'] = since
+        if until is not None:
+            parameters['until'] = until
+
+        return await self.listing('/commits', parameters, page_range=page_range)
+
+    async def pull_requests(self, state=None, direction=None, sort=None, base=None, head=None, page_range={}):
+        logger.info('[Repository] Returning pull-requests available in ' + self.name)
+        parameters = {}
+
+        if state is not None:
+            parameters['state'] = state
+        if direction is not None:
+            parameters['direction'] = direction
+        if sort is not None:
+            parameters['sort'] = sort
+        if base is not None:
+            parameters['base'] = base
+        if head is not None:
+            parameters['head'] = head
+
+        pull_requests = await self.listing('/pulls', parameters, page_range=page_range)
+
+        if page_range:
+            return pull_requests
+
+        # Details, reviews and comments of every pull-request are requested
+        # concurrently, the collector semaphore bounds how many are in flight.
+        numbers = [pull_request['number'] for pull_request in pull_requests if pull_request and 'number' in pull_request]
+        return list(await asyncio.gather(*[self.pull_request_details(number) for number in numbers]))
+
+    async def issues(self, state=None, direction=None, milestone=None, labels=None, creator=None, since=None, assignee=None, mentioned=None, page_range={}):
+        logger.info('[Repository] Returning issues available in ' + self.name)
+        parameters = {}
+
+        if state is not None:
+            parameters['state'] = state
+        if direction is not None:
+            parameters['direction'] = direction
+        if labels is not None:
+            parameters['labels'] = labels
+        if creator is not None:
+            parameters['creator'] = creator
+        if since is not None:
+            parameters['since'] = since
+        if milestone is not None:
+            parameters['milestone'] = milestone
+        if mentioned is not None:
+            parameters['mentioned'] = mentioned
+        if assignee is not None:
+            parameters['assignee'] = assignee
+
+        return await self.listing('/issues', parameters, page_range=page_range)
+
+    async def contributors(self, anonymous='false', page_range={}):
+        logger.info('[Repository] Returning contributors of ' + self.name)
+        parameters = {}
+
+        if anonymous:
+            parameters['anonymous'] = anonymous
+
+        return await self.listing('/contributors', parameters, page_range=page_range)
+
+    async def stars(self, page_range={}):
+        logger.info('[Repository] Returning stars available in ' + self.name)
+        return await self.listing('/stargazers', headers={'Accept': 'application/vnd.github.v3.star+json'}, page_range=page_range)
+
+    async def forks(self, sort=None, page_range={}):
+        logger.info('[Repository] Returning forks available in ' + self.name)
+        parameters = {}
+
+        if sort is not None:
+            parameters['sort'] = sort
+
+        return await self.listing('/forks', parameters, page_range=page_range)
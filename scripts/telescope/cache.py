@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ =  'Felipe Fronchetti'
+__contact__ = 'fronchetti@usp.br'
+
+import os
+import gzip
+import json
+import hashlib
+
+class ResponseCache:
+    # Stores API responses on disk together with their ETag/Last-Modified
+    # headers, so the collector can send conditional requests. GitHub doesn't
+    # count 304 (Not Modified) responses against the rate limit.
+
+    ignored_parameters = ['client_id', 'client_secret', 'access_token']
+    ignored_headers = ['authorization', 'if-none-match', 'if-modified-since']
+
+    def __init__(self, folder, max_size=1024 ** 3, compress=False):
+        self.folder = folder
+        # Once the cache grows beyond max_size bytes, the least recently used
+        # entries are removed.
+        self.max_size = max_size
+        self.compress = compress
+        self.size = None
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    def key(self, url, parameters={}, headers={}):
+        # Credentials never reach the key (nor the disk).
+        parameters = sorted((str(name), str(value)) for name, value in parameters.items() if name not in self.ignored_parameters)
+        headers = sorted((str(name).lower(), str(value)) for name, value in headers.items() if name.lower() not in self.ignored_headers)
+        content = json.dumps([url, parameters, headers])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def filename(self, key, compress):
+        extension = '.json.gz' if compress else '.json'
+        return os.path.join(self.folder, key[:2], key + extension)
+
+    def get(self, key):
+        for compress in [self.compress, not self.compress]:
+            filename = self.filename(key, compress)
+
+            if os.path.isfile(filename):
+                try:
+                    if compress:
+                        with gzip.open(filename, 'rt') as entry_file:
+                            entry = json.load(entry_file)
+                    else:
+                        with open(filename, 'r') as entry_file:
+                            entry = json.load(entry_file)
+                except (IOError, OSError, ValueError):
+                    # Removed by another process or partially written.
+                    return None
+
+                # The modification time is the "last used" time of the LRU.
+                try:
+                    os.utime(filename, None)
+                except OSError:
+                    pass
+
+                return entry
+
+        return None
+
+    def put(self, key, entry):
+        filename = self.filename(key, self.compress)
+        data = json.dumps(entry).encode('utf-8')
+
+        if self.compress:
+            data = gzip.compress(data)
+
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        # Written aside and renamed, readers never see half of an entry.
+        temporary = filename + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary, 'wb') as entry_file:
+            entry_file.write(data)
+        os.replace(temporary, filename)
+
+        if self.size is None:
+            self.size = self.disk_usage()[0]
+        else:
+            self.size = self.size + len(data)
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def disk_usage(self):
+        size = 0
+        entries = []
+
+        for folder, subfolders, filenames in os.walk(self.folder):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(folder, filename)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                size = size + status.st_size
+                entries.append((status.st_mtime, status.st_size, path))
+
+        return size, entries
+
+    def evict(self):
+        # Other processes share the folder, so the real usage is measured
+        # again before removing anything. Evicts down to 90% to avoid doing
+        # this on every write.
+        self.size, entries = self.disk_usage()
+
+        for modified, size, path in sorted(entries):
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.size = self.size - size
+            except OSError:
+                pass
@@ -4,78 +4,365 @@
 __author__ =  'Felipe Fronchetti'
 __contact__ = 'fronchetti@usp.br'
 
+import os
+import random
+import logging
 import requests
 import time
+import multiprocessing
 from datetime import datetime
-import json
+from urllib.parse import urlparse, parse_qs
+from telescope.metrics import endpoint
+
+logger = logging.getLogger(__name__)
+
+class CollectorError(Exception):
+    # Raised when a request still fails after every retry. Returning None
+    # instead would look like an empty page, i.e. the end of a listing.
+
+    def __init__(self, message, url=None, status=None):
+        Exception.__init__(self, message)
+        self.url = url
+        self.status = status
+
+def primary_limit(status, headers):
+    # The rate limit of the token is over (as opposed to a secondary limit).
+    return status in [403, 429] and headers.get('x-ratelimit-remaining') == '0' and 'Retry-After' not in headers
+
+def secondary_limit(status, headers, text):
+    if status not in [403, 429]:
+        return False
+    if 'Retry-After' in headers:
+        return True
+    message = text.lower()
+    return 'secondary rate limit' in message or 'abuse' in message
+
+def retryable(status, headers, text):
+    # Other client errors (401, 404, 422...) won't change on a retry.
+    return status >= 500 or status == 429 or secondary_limit(status, headers, text)
+
+def retry_after(status, headers, text, secondary_wait=60):
+    # Seconds to wait before the next attempt, when GitHub tells (or
+    # implies) it. None means the usual backoff.
+    if 'Retry-After' in headers:
+        try:
+            return max(float(headers['Retry-After']), 0)
+        except ValueError:
+            return secondary_wait
+    if secondary_limit(status, headers, text):
+        return secondary_wait
+    return None
+
+# Rate limit buckets (x-ratelimit-resource) tracked apart by TokenPool: a
+# token can be out of search requests and still have core ones. Buckets that
+# aren't listed share 'other'.
+BUCKETS = ['core', 'search', 'graphql', 'other']
+
+def rate_limit_bucket(url, headers={}):
+    # Bucket of a response (as GitHub names it) or, before the request, of
+    # its url.
+    if 'x-ratelimit-resource' in headers:
+        resource = headers['x-ratelimit-resource']
+        return resource if resource in BUCKETS else 'other'
+
+    path = urlparse(url).path
+
+    if path.endswith('/graphql'):
+        return 'graphql'
+    if path.startswith('/search/') or '/search/' in path:
+        return 'search'
+    return 'core'
+
+class TokenPool:
+    # Tracks the rate limit of several credentials, per bucket (see BUCKETS),
+    # and hands out the one with the largest budget left. The counters live
+    # in shared memory, so every process forked after the pool was created
+    # (e.g. the workers of multiprocessing.Pool in dataset.py) draws from the
+    # same budget.
+
+    def __init__(self, credentials, rate_limit=5000, reserve=10):
+        # A credential is either a (client_id, client_secret) pair or an
+        # OAuth token.
+        self.credentials = list(credentials)
+        self.rate_limit = rate_limit
+        self.reserve = reserve
+        self.lock = multiprocessing.Lock()
+        # Slot of credential i in bucket b: b * len(credentials) + i.
+        self.remaining = multiprocessing.Array('l', [rate_limit] * len(self.credentials) * len(BUCKETS), lock=False)
+        self.reset = multiprocessing.Array('d', [0.0] * len(self.credentials) * len(BUCKETS), lock=False)
+
+        if not self.credentials:
+            raise ValueError('At least one credential must be defined')
+
+    def slot(self, index, bucket):
+        return BUCKETS.index(bucket) * len(self.credentials) + index
+
+    def choose(self, bucket='core'):
+        # Returns the index of the credential to use (its budget is reserved
+        # right away) or None and how many seconds to wait for the next reset.
+        with self.lock:
+            now = time.time()
+            best = None
+
+            for index in range(len(self.credentials)):
+                slot = self.slot(index, bucket)
+
+                if self.remaining[slot] <= self.reserve and self.reset[slot] <= now:
+                    # The window is over, the budget is back until GitHub says otherwise.
+                    self.remaining[slot] = self.rate_limit
+
+                if self.remaining[slot] > self.reserve:
+                    if best is None or self.remaining[slot] > self.remaining[self.slot(best, bucket)]:
+                        best = index
+
+            if best is not None:
+                self.remaining[self.slot(best, bucket)] = self.remaining[self.slot(best, bucket)] - 1
+                return best, 0
+
+            return None, min(self.reset[self.slot(index, bucket)] for index in range(len(self.credentials))) - now
+
+    def acquire(self, metrics=None, bucket='core'):
+        index, wait = self.choose(bucket)
+
+        while index is None:
+            datetime_format = '%Y-%m-%d %H:%M:%S'
+            reset_time = datetime.fromtimestamp(time.time() + wait).strftime(datetime_format)
+            logger.warning('The request limit of every token is over. The process is sleeping until it can be resumed.')
+            logger.warning('The limit will reset on: ' + reset_time)
+            time.sleep(max(wait, 0) + 1)
+            if metrics is not None:
+                metrics.add('rate_limit_wait_seconds_total', max(wait, 0) + 1)
+            index, wait = self.choose(bucket)
+
+        return index
+
+    def update(self, index, remaining, reset, bucket='core'):
+        slot = self.slot(index, bucket)
+
+        with self.lock:
+            # Responses may arrive out of order, a newer window always wins.
+            if reset > self.reset[slot]:
+                self.remaining[slot] = remaining
+                self.reset[slot] = reset
+            elif reset == self.reset[slot]:
+                self.remaining[slot] = min(remaining, self.remaining[slot])
+
+    def authenticate(self, index, parameters, headers):
+        parameters = dict(parameters)
+        headers = dict(headers)
+        credential = self.credentials[index]
+
+        if isinstance(credential, str):
+            headers['Authorization'] = 'token ' + credential
+        else:
+            parameters['client_id'] = credential[0]
+            parameters['client_secret'] = credential[1]
+
+        return parameters, headers
 
 class Collector:
 
-    def __init__(self, client_id, client_secret):
+    def __init__(self, client_id=None, client_secret=None, pool_size=10, api_url='https://api.github.com/', credentials=None, cache=None, retries=5, backoff=1, max_backoff=64, secondary_wait=60, timeout=60, metrics=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.rate_limit_remaining = None
         self.rate_limit_reset = None
+        # Requests are spread over every credential. The token pool has to be
+        # created before the worker processes are forked.
+        if credentials is None:
+            credentials = [(client_id, client_secret)]
+        self.tokens = TokenPool(credentials)
+        self.api_url = api_url
+        # Number of keep-alive connections kept per host. Use None to open
+        # a new connection for every request (no pooling).
+        self.pool_size = pool_size
+        self.session = None
+        self.session_pid = None
+        # Optional telescope.cache.ResponseCache, responses are then
+        # revalidated with conditional requests instead of downloaded again.
+        self.cache = cache
+        # Failed requests (connection errors, timeouts, 5xx and secondary
+        # rate limits) are retried up to `retries` times, waiting a random
+        # time between 0 and backoff * 2^attempt seconds (at most max_backoff).
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Secondary (abuse) limits without a Retry-After header: GitHub asks
+        # for at least a minute between the retries.
+        self.secondary_wait = secondary_wait
+        self.timeout = timeout
+        # Optional telescope.metrics.Metrics, records requests, latencies,
+        # bytes, cache hits, retries and rate limit waits per endpoint.
+        self.metrics = metrics
 
-    def request(self, path, parameters={}, headers={}):
-        try:
-            parameters['client_id'] = self.client_id
-            parameters['client_secret'] = self.client_secret
-            url = 'https://api.github.com/' + path
-            print('Creating request for: ' + url)
-            response = requests.get(url, params=parameters, headers=headers)
-            self.verify_rate_limit(response.headers)
-            return response.json()
-
-        except requests.exceptions.HTTPError as error:
-            with open('exceptions.log', 'a') as exceptions:
-                exceptions.write('[HTTP] ' + error.text)
-        except requests.exceptions.ConnectionError as error:
-            with open('exceptions.log', 'a') as exceptions:
-                exceptions.write('[CONNECTION] ' + error.text)
-        except requests.exceptions.Timeout as error:
-            with open('exceptions.log', 'a') as exceptions:
-                exceptions.write('[TIMEOUT] ' + error.text)
-        except requests.exceptions.RequestException as error:
-            with open('exceptions.log', 'a') as exceptions:
-                exceptions.write('[REQUEST] ' + error.text)
+    def __getstate__(self):
+        # Sessions hold open sockets, they can't be sent to other processes.
+        state = self.__dict__.copy()
+        state['session'] = None
+        state['session_pid'] = None
+        return state
+
+    def http(self):
+        if not self.pool_size:
+            return requests
+
+        # Each process owns its own pool. A session inherited through fork
+        # (e.g. by the workers of multiprocessing.Pool) would share sockets
+        # with its parent, so a new one is created whenever the pid changes.
+        if self.session is None or self.session_pid != os.getpid():
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            self.session = requests.Session()
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+            self.session_pid = os.getpid()
+
+        return self.session
+
+    def close(self):
+        if self.session is not None and self.session_pid == os.getpid():
+            self.session.close()
+        self.session = None
+        self.session_pid = None
+
+    def request(self, path, parameters={}, headers={}, listing=False):
+        content, last_page = self.page(path, parameters, headers, listing)
+        return content
+
+    def page(self, path, parameters={}, headers={}, listing=False):
+        # Returns the content of a page and the number of the last page
+        # announced in the Link header (None when there is no rel="last").
+        # Raises CollectorError when the page can't be collected, or when a
+        # page of a listing isn't a list (404, 409 for an empty repository...).
+        url = self.api_url + path
+        cached = None
+
+        if self.cache is not None:
+            key = self.cache.key(url, parameters, headers)
+            cached = self.cache.get(key)
+
+            if cached is not None:
+                headers = dict(headers)
+                if cached['etag']:
+                    headers['If-None-Match'] = cached['etag']
+                if cached['last_modified']:
+                    headers['If-Modified-Since'] = cached['last_modified']
+
+        response, content = self.send(url, parameters, headers)
+
+        if response.status_code == 304 and cached is not None:
+            logger.debug('[Cache] Not modified: ' + url)
+            if self.metrics is not None:
+                self.metrics.add('cache_hits_total', endpoint=endpoint(url))
+            return cached['content'], cached['last_page']
+
+        if listing and not isinstance(content, list):
+            raise CollectorError('[HTTP] ' + str(response.status_code) + ' ' + url + ' is not a listing: ' + response.text[:200], url, response.status_code)
+
+        last_page = self.last_page(response)
+
+        if self.cache is not None and response.status_code == 200:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+            if etag or last_modified:
+                self.cache.put(key, {'content': content,
+                                     'last_page': last_page,
+                                     'etag': etag,
+                                     'last_modified': last_modified})
+
+        return content, last_page
+
+    def send(self, url, parameters={}, headers={}, authenticate=True, file_type='json'):
+        # Sends a GET request until it succeeds. Returns the response and its
+        # content (parsed JSON, or text). Client errors such as 404 are not
+        # retried, their content (GitHub's error message) is returned as before.
+        attempt = 0
+
+        while True:
+            wait = None
+            status = None
+            request_parameters, request_headers = parameters, headers
+
+            if authenticate:
+                token = self.tokens.acquire(self.metrics, rate_limit_bucket(url))
+                request_parameters, request_headers = self.tokens.authenticate(token, parameters, headers)
+
+            try:
+                logger.debug('Creating request for: ' + url)
+                started = time.time()
+                response = self.http().get(url, params=request_parameters, headers=request_headers, timeout=self.timeout)
+                status = response.status_code
+
+                if self.metrics is not None:
+                    self.metrics.request(url, status, time.time() - started, len(response.content))
+
+                if authenticate:
+                    self.verify_rate_limit(response.headers, token, rate_limit_bucket(url, response.headers))
+
+                if status == 304:
+                    return response, None
+
+                if primary_limit(status, response.headers):
+                    # The token pool now knows this token is out of requests in
+                    # this bucket, the next attempt uses another one (or sleeps
+                    # until the reset). It still counts as an attempt.
+                    if self.metrics is not None:
+                        self.metrics.add('rate_limit_exhausted_total', endpoint=endpoint(url))
+                    failure = '[RATE-LIMIT] ' + str(status) + ' ' + url + ' ' + response.text[:200]
+                    wait = 0
+                elif not retryable(status, response.headers, response.text):
+                    if file_type == 'json':
+                        return response, response.json()
+                    return response, response.text
+                else:
+                    failure = '[HTTP] ' + str(status) + ' ' + url + ' ' + response.text[:200]
+                    wait = retry_after(status, response.headers, response.text, self.secondary_wait)
+
+            except ValueError as error:
+                # Truncated or invalid body.
+                failure = '[JSON] ' + url + ' ' + str(error)
+            except requests.exceptions.ConnectionError as error:
+                failure = '[CONNECTION] ' + url + ' ' + str(error)
+            except requests.exceptions.Timeout as error:
+                failure = '[TIMEOUT] ' + url + ' ' + str(error)
+            except requests.exceptions.RequestException as error:
+                failure = '[REQUEST] ' + url + ' ' + str(error)
+
+            logger.warning(failure)
+
+            if attempt >= self.retries:
+                if self.metrics is not None:
+                    self.metrics.add('failures_total', endpoint=endpoint(url))
+                raise CollectorError('Request failed after ' + str(attempt + 1) + ' attempts: ' + failure, url, status)
+
+            if wait is None:
+                wait = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+            attempt = attempt + 1
+            logger.info('[API] Request failed, retrying in ' + str(round(wait, 1)) + ' seconds (' + str(attempt) + ' of ' + str(self.retries) + ').')
+
+            if self.metrics is not None:
+                self.metrics.add('retries_total', endpoint=endpoint(url), reason=failure.split(' ')[0].strip('[]').lower())
+                self.metrics.add('retry_wait_seconds_total', wait)
+
+            time.sleep(wait)
+
+    def last_page(self, response):
+        if 'last' in response.links:
+            query = parse_qs(urlparse(response.links['last']['url']).query)
+            if 'page' in query:
+                return int(query['page'][0])
+        return None
 
     def custom_request(self, url, parameters={}, headers={}, file_type='text'):
-        try:
-            print('Creating request for: ' + url)
-            response = requests.get(url, params=parameters, headers=headers)
-
-            if file_type == 'json':
-                return response.json()
-            if file_type == 'text':
-                return response.text
-
-        except requests.exceptions.HTTPError as error:
-            with open('exceptions.log', 'a') as exceptions:
-                exceptions.write('[HTTP] ' + error.text)
-        except requests.exceptions.ConnectionError as error:
-            with open('exceptions.log', 'a') as exceptions:
-                exceptions.write('[CONNECTION] ' + error.text)
-        except requests.exceptions.Timeout as error:
-            with open('exceptions.log', 'a') as exceptions:
-                exceptions.write('[TIMEOUT] ' + error.text)
-        except requests.exceptions.RequestException as error:
-            with open('exceptions.log', 'a') as exceptions:
-                exceptions.write('[REQUEST] ' + error.text)
-
-    def verify_rate_limit(self, headers):
-        self.rate_limit_remaining = int(headers['x-ratelimit-remaining'])
-        self.rate_limit_reset = int(headers['x-ratelimit-reset'])
-
-        datetime_format = '%Y-%m-%d %H:%M:%S'
-        reset_time = datetime.fromtimestamp(self.rate_limit_reset).strftime(datetime_format)
-        current_time = datetime.now().strftime(datetime_format)
-
-        print('[API] Requests Remaining:' + str(self.rate_limit_remaining))
-
-        if self.rate_limit_remaining < 10:
-            while(reset_time > current_time):
-                print('The request limit is over. The process is sleeping until it can be resumed.')
-                print('The limit will reset on: ' + reset_time)
-                current_time = datetime.now().strftime(datetime_format)
-                time.sleep(30)
+        # Files outside the API (e.g. raw READMEs), no credentials are sent.
+        response, content = self.send(url, parameters, headers, authenticate=False, file_type=file_type)
+        return content
+
+    def verify_rate_limit(self, headers, token=0, bucket='core'):
+        if 'x-ratelimit-remaining' in headers:
+            self.rate_limit_remaining = int(headers['x-ratelimit-remaining'])
+            self.rate_limit_reset = int(headers['x-ratelimit-reset'])
+            self.tokens.update(token, self.rate_limit_remaining, self.rate_limit_reset, bucket)
+
+            logger.debug('[API] Requests Remaining:' + str(self.rate_limit_remaining))
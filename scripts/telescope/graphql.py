@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ =  'Felipe Fronchetti'
+__contact__ = 'fronchetti@usp.br'
+
+import os
+import json
+import time
+import random
+import logging
+import requests
+from telescope.collector import TokenPool, CollectorError, primary_limit, retryable, retry_after, rate_limit_bucket
+
+logger = logging.getLogger(__name__)
+
+class GraphQLCollector:
+    # Sends queries to the GitHub GraphQL API. Unlike the REST API, it only
+    # accepts OAuth tokens (client id/secret pairs are not enough).
+
+    def __init__(self, tokens, pool_size=10, api_url='https://api.github.com/graphql', metrics=None, retries=5, backoff=1, max_backoff=64, secondary_wait=60, timeout=60):
+        self.tokens = TokenPool(tokens)
+        self.pool_size = pool_size
+        self.api_url = api_url
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
+        self.session = None
+        self.session_pid = None
+        # Optional telescope.metrics.Metrics, see Collector.
+        self.metrics = metrics
+        # Failed queries are retried as the requests of Collector (see its
+        # parameters).
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.secondary_wait = secondary_wait
+        self.timeout = timeout
+
+    def http(self):
+        # One pool per process, as in Collector.
+        if self.session is None or self.session_pid != os.getpid():
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            self.session = requests.Session()
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+            self.session_pid = os.getpid()
+
+        return self.session
+
+    def query(self, query, variables={}):
+        # Returns the data of a query. Failed queries (connection errors,
+        # timeouts, 5xx, rate limits, invalid bodies) are retried as in
+        # Collector.send, CollectorError is raised when they still fail or
+        # when GitHub answers with errors only.
+        attempt = 0
+
+        while True:
+            wait = None
+            status = None
+            token = self.tokens.acquire(self.metrics, 'graphql')
+            parameters, headers = self.tokens.authenticate(token, {}, {})
+
+            try:
+                logger.debug('Creating GraphQL query for: ' + self.api_url)
+                started = time.time()
+                response = self.http().post(self.api_url, json={'query': query, 'variables': variables}, headers=headers, timeout=self.timeout)
+                status = response.status_code
+
+                if self.metrics is not None:
+                    self.metrics.request('graphql', status, time.time() - started, len(response.content))
+
+                if 'x-ratelimit-remaining' in response.headers:
+                    self.rate_limit_remaining = int(response.headers['x-ratelimit-remaining'])
+                    self.rate_limit_reset = int(response.headers['x-ratelimit-reset'])
+                    self.tokens.update(token, self.rate_limit_remaining, self.rate_limit_reset, rate_limit_bucket(self.api_url, response.headers))
+                    logger.debug('[API] Points Remaining:' + str(self.rate_limit_remaining))
+
+                if primary_limit(status, response.headers):
+                    # As in Collector.send, another token (or the reset) is
+                    # used next, and it counts as an attempt.
+                    if self.metrics is not None:
+                        self.metrics.add('rate_limit_exhausted_total', endpoint='graphql')
+                    failure = '[RATE-LIMIT] ' + str(status) + ' ' + self.api_url + ' ' + response.text[:200]
+                    wait = 0
+                elif retryable(status, response.headers, response.text):
+                    failure = '[HTTP] ' + str(status) + ' ' + self.api_url + ' ' + response.text[:200]
+                    wait = retry_after(status, response.headers, response.text, self.secondary_wait)
+                else:
+                    content = response.json()
+                    errors = content.get('errors') or []
+
+                    if any(error.get('type') == 'RATE_LIMITED' for error in errors):
+                        # The token pool knows the points are over (see above).
+                        failure = '[RATE-LIMIT] ' + str(status) + ' ' + self.api_url + ' ' + json.dumps(errors)[:200]
+                        wait = 0
+                    else:
+                        if errors:
+                            logger.error('[GRAPHQL] ' + json.dumps(errors))
+
+                        if content.get('data') is None:
+                            raise CollectorError('[GRAPHQL] ' + str(status) + ' ' + json.dumps(errors or content)[:200], self.api_url, status)
+
+                        return content['data']
+
+            except ValueError as error:
+                # Truncated or invalid body.
+                failure = '[JSON] ' + self.api_url + ' ' + str(error)
+            except requests.exceptions.ConnectionError as error:
+                failure = '[CONNECTION] ' + self.api_url + ' ' + str(error)
+            except requests.exceptions.Timeout as error:
+                failure = '[TIMEOUT] ' + self.api_url + ' ' + str(error)
+            except requests.exceptions.RequestException as error:
+                failure = '[REQUEST] ' + self.api_url + ' ' + str(error)
+
+            logger.warning(failure)
+
+            if attempt >= self.retries:
+                if self.metrics is not None:
+                    self.metrics.add('failures_total', endpoint='graphql')
+                raise CollectorError('Query failed after ' + str(attempt + 1) + ' attempts: ' + failure, self.api_url, status)
+
+            if wait is None:
+                wait = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+            attempt = attempt + 1
+            logger.info('[API] Query failed, retrying in ' + str(round(wait, 1)) + ' seconds (' + str(attempt) + ' of ' + str(self.retries) + ').')
+
+            if self.metrics is not None:
+                self.metrics.add('retries_total', endpoint='graphql', reason=failure.split(' ')[0].strip('[]').lower())
+                self.metrics.add('retry_wait_seconds_total', wait)
+
+            time.sleep(wait)
+
+class GraphQLRepository:
+    # Collects the pull-requests (with reviews and comments), stars and forks
+    # of a repository with batched GraphQL queries. Every query asks for the
+    # next page of all the connections that aren't finished yet, and only
+    # for the fields the analyses use. Items have the same shape as the
+    # (projected) REST items, see dataset.PROJECTIONS: 'reviews' holds the
+    # review comments (/pulls/N/comments), taken from the review threads.
+
+    connections = {
+        'pull_requests': '''
+            pullRequests(first: %(size)d, after: $pull_requests, orderBy: {field: CREATED_AT, direction: DESC}) {
+                pageInfo { hasNextPage endCursor }
+                nodes {
+                    number state createdAt updatedAt closedAt mergedAt
+                    author { login }
+                    mergedBy { login }
+                    reviewThreads(first: 50) {
+                        pageInfo { hasNextPage endCursor }
+                        nodes %(thread)s
+                    }
+                    comments(first: 100) {
+                        pageInfo { hasNextPage endCursor }
+                        nodes { author { login } createdAt }
+                    }
+                }
+            }''',
+        'stars': '''
+            stargazers(first: 100, after: $stars, orderBy: {field: STARRED_AT, direction: ASC}) {
+                pageInfo { hasNextPage endCursor }
+                edges { starredAt node { login } }
+            }''',
+        'forks': '''
+            forks(first: 100, after: $forks, orderBy: {field: CREATED_AT, direction: DESC}) {
+                pageInfo { hasNextPage endCursor }
+                nodes { databaseId nameWithOwner createdAt owner { login } }
+            }'''
+    }
+
+    # Comments of a review thread, in pages of 50.
+    thread = '''{
+                        id
+                        comments(first: 50) {
+                            pageInfo { hasNextPage endCursor }
+                            nodes { author { login } createdAt }
+                        }
+                    }'''
+
+    def __init__(self, organization, name, collector, pull_requests_per_page=50):
+        self.name = name
+        self.organization = organization
+        self.github = collector
+        # Pull-requests carry up to 50 review threads and 100 comments each, smaller
+        # pages keep the queries below GitHub's timeout.
+        self.pull_requests_per_page = pull_requests_per_page
+
+    def timelines(self, resources=['pull_requests', 'stars', 'forks'], journal=None):
+        # Yields (resource, page of items) as the pages arrive. With a journal
+        # (telescope.journal.Journal), the pages of a previous run are read
+        # back and the queries continue from their cursors.
+        cursors = dict((resource, None) for resource in resources)
+        pending = list(resources)
+
+        if journal is not None:
+            for entry in journal.pages(['timelines', self.organization, self.name, resources, self.pull_requests_per_page]):
+                for resource, page in entry['pages']:
+                    yield resource, page
+                cursors = entry['cursors']
+                pending = entry['pending']
+
+        while pending:
+            variables = {'owner': self.organization, 'name': self.name}
+            declarations = ['$owner: String!', '$name: String!']
+            fields = []
+
+            for resource in pending:
+                declarations.append('$' + resource + ': String')
+                variables[resource] = cursors[resource]
+                fields.append(self.connections[resource] % {'size': self.pull_requests_per_page, 'thread': self.thread})
+
+            query = 'query(' + ', '.join(declarations) + ') { repository(owner: $owner, name: $name) {' + ''.join(fields) + '} }'
+            logger.info('[Repository] Returning ' + ', '.join(pending) + ' of ' + self.name + ' (GraphQL)')
+            data = self.github.query(query, variables)
+
+            # Stopping here would look like the end of the timelines.
+            if not data.get('repository'):
+                raise CollectorError('[GRAPHQL] Repository ' + self.organization + '/' + self.name + ' not found', self.github.api_url)
+
+            repository = data['repository']
+            pages = []
+            finished = []
+
+            for resource in pending:
+                connection = repository[self.connection_name(resource)]
+                pages.append([resource, self.convert(resource, connection)])
+
+                if connection['pageInfo']['hasNextPage']:
+                    cursors[resource] = connection['pageInfo']['endCursor']
+                else:
+                    finished.append(resource)
+
+            pending = [resource for resource in pending if resource not in finished]
+
+            if journal is not None:
+                journal.append({'pages': pages, 'cursors': cursors, 'pending': pending})
+
+            for resource, page in pages:
+                yield resource, page
+
+    def connection_name(self, resource):
+        return {'pull_requests': 'pullRequests', 'stars': 'stargazers', 'forks': 'forks'}[resource]
+
+    def convert(self, resource, connection):
+        if resource == 'stars':
+            return [{'starred_at': edge['starredAt'], 'user': login(edge['node'])} for edge in connection['edges']]
+        if resource == 'forks':
+            return [{'id': node['databaseId'],
+                     'full_name': node['nameWithOwner'],
+                     'created_at': node['createdAt'],
+                     'owner': login(node['owner'])} for node in connection['nodes']]
+
+        pull_requests = []
+
+        for node in connection['nodes']:
+            pull_requests.append({'number': node['number'],
+                                  'state': 'open' if node['state'] == 'OPEN' else 'closed',
+                                  'created_at': node['createdAt'],
+                                  'updated_at': node['updatedAt'],
+                                  'closed_at': node['closedAt'],
+                                  'merged_at': node['mergedAt'],
+                                  'merged_by': login(node['mergedBy']),
+                                  'user': login(node['author']),
+                                  'reviews': self.review_comments(node),
+                                  'comments': self.activity(node, 'comments')})
+
+        return pull_requests
+
+    def activity(self, node, connection_name, fields='{ author { login } createdAt }'):
+        # Nodes of a connection of a pull-request (comments, reviewThreads).
+        connection = node[connection_name]
+        nodes = list(connection['nodes'])
+
+        # Pull-requests with more than a page of comments (or threads) are
+        # rare, the remaining pages are requested for them alone.
+        while connection['pageInfo']['hasNextPage']:
+            query = '''query($owner: String!, $name: String!, $number: Int!, $cursor: String) {
+                repository(owner: $owner, name: $name) {
+                    pullRequest(number: $number) {
+                        %s(first: 50, after: $cursor) {
+                            pageInfo { hasNextPage endCursor }
+                            nodes %s
+                        }
+                    }
+                }
+            }''' % (connection_name, fields)
+            variables = {'owner': self.organization,
+                         'name': self.name,
+                         'number': node['number'],
+                         'cursor': connection['pageInfo']['endCursor']}
+            data = self.github.query(query, variables)
+
+            if not data.get('repository'):
+                raise CollectorError('[GRAPHQL] Repository ' + self.organization + '/' + self.name + ' not found', self.github.api_url)
+
+            connection = data['repository']['pullRequest'][connection_name]
+            nodes.extend(connection['nodes'])
+
+        if connection_name == 'comments':
+            return [{'user': login(item['author']), 'created_at': item['createdAt']} for item in nodes]
+        return nodes
+
+    def review_comments(self, node):
+        # Comments of every review thread, oldest first as /pulls/N/comments.
+        items = []
+
+        for thread in self.activity(node, 'reviewThreads', self.thread):
+            connection = thread['comments']
+            comments = list(connection['nodes'])
+
+            while connection['pageInfo']['hasNextPage']:
+                query = '''query($id: ID!, $cursor: String) {
+                    node(id: $id) {
+                        ... on PullRequestReviewThread {
+                            comments(first: 50, after: $cursor) {
+                                pageInfo { hasNextPage endCursor }
+                                nodes { author { login } createdAt }
+                            }
+                        }
+                    }
+                }'''
+                data = self.github.query(query, {'id': thread['id'], 'cursor': connection['pageInfo']['endCursor']})
+
+                if not data.get('node'):
+                    raise CollectorError('[GRAPHQL] Review thread ' + thread['id'] + ' of ' + self.organization + '/' + self.name + ' not found', self.github.api_url)
+
+                connection = data['node']['comments']
+                comments.extend(connection['nodes'])
+
+            items.extend({'user': login(comment['author']), 'created_at': comment['createdAt']} for comment in comments)
+
+        items.sort(key=lambda item: item['created_at'])
+        return items
+
+    def pull_requests(self):
+        return [item for resource, page in self.timelines(['pull_requests']) for item in page]
+
+    def stars(self):
+        return [item for resource, page in self.timelines(['stars']) for item in page]
+
+    def forks(self):
+        return [item for resource, page in self.timelines(['forks']) for item in page]
+
+def login(actor):
+    # Deleted accounts come back as null.
+    if actor is None:
+        return None
+    return {'login': actor['login']}
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ =  'Felipe Fronchetti'
+__contact__ = 'fronchetti@usp.br'
+
+import os
+import json
+
+class Journal:
+    # Append-only checkpoint of a listing: one line per completed page. The
+    # first line identifies the listing (resource, parameters, page size),
+    # so a journal written for another request is never resumed.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.key = None
+
+    def pages(self, key):
+        self.key = json.dumps(key, sort_keys=True)
+        pages = []
+
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r') as journal_file:
+                lines = journal_file.read().split('\n')
+
+            if lines[0] == self.key:
+                for line in lines[1:]:
+                    try:
+                        pages.append(json.loads(line))
+                    except ValueError:
+                        # A page that was being written when the crawl stopped.
+                        break
+
+        # The journal is rewritten with the valid pages only, so a partial line
+        # (or a journal of another listing) never ends up in the middle of it.
+        with open(self.filename, 'w') as journal_file:
+            journal_file.write(self.key + '\n')
+            for page in pages:
+                journal_file.write(json.dumps(page) + '\n')
+
+        return pages
+
+    def append(self, page):
+        with open(self.filename, 'a') as journal_file:
+            journal_file.write(json.dumps(page) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def remove(self):
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ =  'Felipe Fronchetti'
+__contact__ = 'fronchetti@usp.br'
+
+import os
+import re
+import json
+import time
+import threading
+from urllib.parse import urlparse
+
+# Upper bounds (in seconds) of the request latency histogram.
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+def endpoint(url):
+    # Groups requests by endpoint: repos/owner/name/pulls/12/comments becomes
+    # repos/:owner/:name/pulls/:number/comments. Files outside the API are
+    # grouped by host.
+    parsed = urlparse(url)
+
+    if parsed.netloc and parsed.netloc != 'api.github.com' and not parsed.netloc.startswith('127.0.0.1') and not parsed.netloc.startswith('localhost'):
+        return parsed.netloc
+
+    segments = [segment for segment in parsed.path.split('/') if segment]
+
+    if len(segments) >= 3 and segments[0] == 'repos':
+        segments[1] = ':owner'
+        segments[2] = ':name'
+
+    for index, segment in enumerate(segments):
+        if segment.isdigit():
+            segments[index] = ':number'
+        elif re.match('^[0-9a-f]{40}$', segment):
+            segments[index] = ':sha'
+
+    return '/'.join(segments)
+
+class Metrics:
+    # Counters and histograms of a crawl, labelled by endpoint (and status,
+    # reason...). flush() hands what was recorded since the last flush to the
+    # sinks, so the snapshots of several processes can simply be added up
+    # (see merge).
+
+    def __init__(self, sinks=[]):
+        self.sinks = list(sinks)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def key(self, name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def add(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0, 'count': 0}
+
+            histogram = self.histograms[key]
+            index = len(LATENCY_BUCKETS)
+            for position, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    index = position
+                    break
+
+            histogram['buckets'][index] = histogram['buckets'][index] + 1
+            histogram['sum'] = histogram['sum'] + value
+            histogram['count'] = histogram['count'] + 1
+
+    def request(self, url, status, seconds, size):
+        # Everything recorded for a response the API sent back.
+        name = endpoint(url)
+        self.add('requests_total', endpoint=name, status=status)
+        self.add('response_bytes_total', size, endpoint=name)
+        self.observe('request_seconds', seconds, endpoint=name)
+
+    def snapshot(self):
+        with self.lock:
+            return {'time': time.time(),
+                    'pid': os.getpid(),
+                    'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())],
+                    'histograms': [dict(histogram, name=name, labels=dict(labels)) for (name, labels), histogram in sorted(self.histograms.items())]}
+
+    def flush(self):
+        snapshot = self.snapshot()
+
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+        for sink in self.sinks:
+            sink.emit(snapshot)
+
+        return snapshot
+
+def merge(snapshots):
+    # Adds up snapshots (e.g. the flushes of every worker of a crawl).
+    total = Metrics()
+
+    for snapshot in snapshots:
+        for counter in snapshot['counters']:
+            total.add(counter['name'], counter['value'], **counter['labels'])
+
+        for histogram in snapshot['histograms']:
+            key = total.key(histogram['name'], histogram['labels'])
+            current = total.histograms.setdefault(key, {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0, 'count': 0})
+            current['buckets'] = [a + b for a, b in zip(current['buckets'], histogram['buckets'])]
+            current['sum'] = current['sum'] + histogram['sum']
+            current['count'] = current['count'] + histogram['count']
+
+    return total.snapshot()
+
+def prometheus(snapshot, prefix='telescope_'):
+    # Prometheus text exposition format.
+    lines = []
+
+    def labels(values, extra={}):
+        values = dict(values, **extra)
+        if not values:
+            return ''
+        return '{' + ','.join(label + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for label, value in sorted(values.items())) + '}'
+
+    names = []
+    for counter in snapshot['counters']:
+        if counter['name'] not in names:
+            names.append(counter['name'])
+            lines.append('# TYPE ' + prefix + counter['name'] + ' counter')
+        lines.append(prefix + counter['name'] + labels(counter['labels']) + ' ' + str(counter['value']))
+
+    for histogram in snapshot['histograms']:
+        name = prefix + histogram['name']
+        if histogram['name'] not in names:
+            names.append(histogram['name'])
+            lines.append('# TYPE ' + name + ' histogram')
+
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], histogram['buckets']):
+            cumulative = cumulative + count
+            lines.append(name + '_bucket' + labels(histogram['labels'], {'le': bound}) + ' ' + str(cumulative))
+        lines.append(name + '_sum' + labels(histogram['labels']) + ' ' + str(histogram['sum']))
+        lines.append(name + '_count' + labels(histogram['labels']) + ' ' + str(histogram['count']))
+
+    return '\n'.join(lines) + '\n'
+
+class MemorySink:
+    # Keeps the snapshots in memory, total() adds them up.
+
+    def __init__(self):
+        self.snapshots = []
+
+    def emit(self, snapshot):
+        self.snapshots.append(snapshot)
+
+    def total(self):
+        return merge(self.snapshots)
+
+class JSONLinesSink:
+    # Appends one snapshot per line. Lines are written with a single call, so
+    # several processes can share the file.
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def emit(self, snapshot):
+        with open(self.filename, 'a') as metrics_file:
+            metrics_file.write(json.dumps(snapshot) + '\n')
+
+    def snapshots(self):
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r') as metrics_file:
+                for line in metrics_file:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def total(self):
+        return merge(self.snapshots())
+
+class PrometheusSink:
+    # Rewrites a Prometheus text file with everything received so far (by
+    # this process, use JSONLinesSink and merge for several processes).
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.received = []
+
+    def emit(self, snapshot):
+        self.received = [merge(self.received + [snapshot])]
+        temporary = self.filename + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary, 'w') as metrics_file:
+            metrics_file.write(prometheus(self.received[0]))
+        os.replace(temporary, self.filename)
@@ -4,39 +4,181 @@
 __author__ =  'Felipe Fronchetti'
 __contact__ = 'fronchetti@usp.br'
 
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Page size used by GitHub when per_page is not sent. Page ranges have always
+# been written in pages of this size, unless they say otherwise.
+DEFAULT_PAGE_SIZE = 30
+
+def page_window(page_range, per_page):
+    # Translates a page range ({'first_page', 'last_page', 'per_page'}, last
+    # page excluded) into the pages that cover the same items when requested
+    # with per_page items each. Returns the pages to request, the number of
+    # items to skip on the first of them and the number of items to keep.
+    size = page_range.get('per_page', DEFAULT_PAGE_SIZE)
+    first_item = (page_range['first_page'] - 1) * size
+
+    if page_range.get('last_page') is None:
+        # Open range, pages are requested until an empty one comes back.
+        first_page = first_item // per_page + 1
+        return first_page, None, first_item - (first_page - 1) * per_page, None
+
+    last_item = (page_range['last_page'] - 1) * size
+
+    if last_item <= first_item:
+        return 1, 1, 0, 0
+
+    first_page = first_item // per_page + 1
+    last_page = (last_item - 1) // per_page + 2
+    skip = first_item - (first_page - 1) * per_page
+
+    return first_page, last_page, skip, last_item - first_item
+
 class Repository:
 
-    def __init__(self, organization, name, collector):
+    def __init__(self, organization, name, collector, per_page=100, fan_out=False, workers=10):
         self.name = name
         self.organization = organization
         self.github = collector
+        # Items requested per page in every listing (GitHub accepts up to 100).
+        self.per_page = per_page
+        # In fan-out mode the first page of a listing tells how many pages
+        # exist (Link header, rel="last") and the remaining pages are requested
+        # concurrently by a pool of threads. Keep workers <= the collector pool size.
+        self.fan_out = fan_out
+        self.workers = workers
+
+    def path(self, resource=''):
+        return 'repos/' + self.organization + '/' + self.name + resource
+
+    def pages(self, resource, parameters={}, headers={}, page_range={}):
+        parameters = dict(parameters)
+        parameters['per_page'] = self.per_page
+        first_page, last_page, skip, remaining = 1, None, 0, None
+
+        if page_range:
+            first_page, last_page, skip, remaining = page_window(page_range, self.per_page)
+
+        if last_page is not None:
+            for page_number in range(first_page, last_page):
+                parameters['page'] = page_number
+                request = self.github.request(self.path(resource), parameters, headers, listing=True)
+
+                if request:
+                    request = request[skip:skip + remaining]
+                    skip = 0
+                    remaining = remaining - len(request)
+
+                    if request:
+                        yield request
+        elif self.fan_out:
+            parameters['page'] = first_page
+            request, last_page = self.github.page(self.path(resource), parameters, headers, listing=True)
+
+            if request:
+                yield request[skip:]
+
+                if last_page is not None and last_page > first_page:
+                    def request_page(page_number):
+                        page_parameters = dict(parameters)
+                        page_parameters['page'] = page_number
+                        return self.github.request(self.path(resource), page_parameters, headers, listing=True)
+
+                    # map() returns the pages in order, whatever order they arrive in.
+                    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                        for request in executor.map(request_page, range(first_page + 1, last_page + 1)):
+                            if request:
+                                yield request
+        else:
+            pages_exist = True
+            page_number = first_page
+
+            while(pages_exist):
+                parameters['page'] = page_number
+                request = self.github.request(self.path(resource), parameters, headers, listing=True)
+
+                if request:
+                    if request[skip:]:
+                        yield request[skip:]
+                    skip = 0
+                else:
+                    pages_exist = False
+
+                page_number = page_number + 1
+
+    def resume(self, fetch, key, page_range={}, journal=None):
+        # fetch(page_range) yields the pages of a listing. With a journal
+        # (telescope.journal.Journal), the pages completed by a previous run
+        # are read back and the listing continues from the following page.
+        if journal is None or page_range.get('last_page') is not None:
+            for page in fetch(page_range):
+                yield page
+            return
+
+        completed = journal.pages([key, self.per_page, page_range])
+
+        for page in completed:
+            yield page
+
+        if completed:
+            first_page = page_window(page_range or {'first_page': 1, 'per_page': self.per_page}, self.per_page)[0]
+            page_range = {'first_page': first_page + len(completed), 'per_page': self.per_page}
+
+        for page in fetch(page_range):
+            journal.append(page)
+            yield page
+
+    def items(self, resource, parameters={}, headers={}, page_range={}, journal=None):
+        fetch = lambda page_range: self.pages(resource, parameters, headers, page_range)
+
+        for page in self.resume(fetch, [resource, parameters, headers], page_range, journal):
+            for item in page:
+                yield item
+
+    def listing(self, resource, parameters={}, headers={}, page_range={}, journal=None):
+        return list(self.items(resource, parameters, headers, page_range, journal))
+
+    def newer_pages(self, pages, field, since):
+        # Keeps the items whose field (an ISO 8601 date) is after since. The
+        # listing must be sorted from newest to oldest: it stops at the first
+        # page holding an older item, so older pages are never requested.
+        for page in pages:
+            newer = [item for item in page if item and item.get(field) and item[field] > since]
+
+            if newer:
+                yield newer
+            if len(newer) < len(page):
+                break
 
     def about(self):
-        print('[Repository] Returning general information about' + self.name)
+        logger.info('[Repository] Returning general information about ' + self.name)
         return self.github.request('repos/' + self.organization + '/' + self.name)
 
     def languages(self):
-        print('[Repository] Returning languages used in the project')
+        logger.info('[Repository] Returning languages used in the project')
         return self.github.request('repos/' + self.organization + '/' + self.name + '/languages')
 
     def commit(self, sha):
-        print('[Repository] Returning commit ' + str(sha) + ' in ' + self.name)
+        logger.info('[Repository] Returning commit ' + str(sha) + ' in ' + self.name)
         return self.github.request('repos/' + self.organization + '/' + self.name + '/commits/' + str(sha))
 
     def pull_request(self, number):
-        print('[Repository] Returning pull-request #' + str(number) + ' in ' + self.name)
+        logger.info('[Repository] Returning pull-request #' + str(number) + ' in ' + self.name)
         return self.github.request('repos/' + self.organization + '/' + self.name + '/pulls/' + str(number))
 
     def issue(self, number):
-        print('[Repository] Returning issue #' + str(number) + ' in ' + self.name)
+        logger.info('[Repository] Returning issue #' + str(number) + ' in ' + self.name)
         return self.github.request('repos/' + self.organization + '/' + self.name + '/issues/' + str(number))
     
     def community_metrics(self):
-        print('[Repository] Returning community metrics of project ' + self.name)
+        logger.info('[Repository] Returning community metrics of project ' + self.name)
         return self.github.request('repos/' + self.organization + '/' + self.name + '/community/profile', headers={'Accept': 'application/vnd.github.black-panther-preview+json'})
 
     def readme(self):
-        print('[Repository] Returning README.md file of project ' + self.name)
+        logger.info('[Repository] Returning README.md file of project ' + self.name)
         metrics = self.community_metrics()
         readme = []
 
@@ -48,7 +190,7 @@ class Repository:
         return readme
 
     def contributing(self):
-        print('[Repository] Returning CONTRIBUTING.md file of project ' + self.name)
+        logger.info('[Repository] Returning CONTRIBUTING.md file of project ' + self.name)
         metrics = self.community_metrics()
         contributing = []
 
@@ -59,10 +201,11 @@ class Repository:
                 contributing = self.github.custom_request(description['download_url'])
         return contributing
 
-    def commits(self, sha=None, path=None, author=None, since=None, until=None, page_range={}):
-        print('[Repository] Returning commits available in ' + self.name)
+    # The iter_* methods yield the items of a listing page by page, so only
+    # one page is kept in memory. The methods without the prefix return lists.
 
-        commits = []
+    def iter_commits(self, sha=None, path=None, author=None, since=None, until=None, page_range={}, journal=None):
+        logger.info('[Repository] Returning commits available in ' + self.name)
         parameters = {}
 
         if sha is not None:
@@ -72,42 +215,17 @@ class Repository:
         if author is not None:
             parameters['author'] = author
         if since is not None:
-            paramethers['since'] = since
+            parameters['since'] = since
         if until is not None:
-            paramethers['until'] = until
+            parameters['until'] = until
 
-        if page_range:
-            first_page = page_range['first_page']
-            last_page = page_range['last_page']
+        return self.items('/commits', parameters, page_range=page_range, journal=journal)
 
-            for page_number in range(first_page, last_page):
-                parameters['page'] = str(page_number)
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/commits', parameters)
+    def commits(self, sha=None, path=None, author=None, since=None, until=None, page_range={}, journal=None):
+        return list(self.iter_commits(sha, path, author, since, until, page_range, journal))
 
-                if request:
-                    for commit in request:
-                        commits.append(commit)
-        else:
-            pages_exist = True
-            page_number = 1
-
-            while(pages_exist):
-                parameters['page'] = page_number
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/commits', parameters)
-
-                if request:
-                    for commit in request:
-                        commits.append(commit)
-                else:
-                    pages_exist = False
-
-                page_number = page_number + 1
-
-        return commits
-    
-    def pull_requests(self, state=None, direction=None, sort=None, base=None, head=None, page_range={}):
-        print('[Repository] Returning pull-requests available in ' + self.name)
-        pull_requests = []
+    def iter_pull_requests(self, state=None, direction=None, sort=None, base=None, head=None, since=None, page_range={}, journal=None, bulk=False, comment_journals=(None, None), compact=None):
+        logger.info('[Repository] Returning pull-requests available in ' + self.name)
         parameters = {}
 
         if state is not None:
@@ -122,103 +240,107 @@ class Repository:
             parameters['head'] = head
 
         if page_range:
-            first_page = page_range['first_page']
-            last_page = page_range['last_page']
+            return self.items('/pulls', parameters, page_range=page_range, journal=journal)
+
+        # In bulk mode, reviews and comments come from the repository-wide
+        # listings and are joined to the pull-requests by number. Only merged
+        # pull-requests are requested one by one, merged_by isn't in the listing.
+        # When refreshing (since), only a few pull-requests are requested and
+        # each of them needs all of its comments, so bulk mode isn't used.
+        # compact(field, item) reduces each review or comment ('reviews' or
+        # 'comments') to what is kept, the listings are checkpointed in
+        # comment_journals (reviews, comments).
+        if bulk and since is None:
+            reviews = self.grouped('/pulls/comments', 'pull_request_url', 'reviews', compact, comment_journals[0])
+            comments = self.grouped('/issues/comments', 'issue_url', 'comments', compact, comment_journals[1])
+            details = lambda pull_request: self.pull_request_join(pull_request, reviews, comments)
+        else:
+            details = lambda pull_request: self.pull_request_details(pull_request['number'])
 
-            for page_number in range(first_page, last_page):
-                parameters['page'] = page_number
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/pulls', parameters)
+        def fetch(page_range):
+            pages = self.pages('/pulls', parameters, page_range=page_range)
 
-                if request:
-                    for pull_request in request:
-                        pull_requests.append(pull_request)
-        else:
-            pages_exist = True
-            page_number = 1
+            # GitHub has no since filter for pull-requests. With sort='updated'
+            # and direction='desc', the listing stops at the first one that
+            # wasn't updated after since.
+            if since is not None:
+                pages = self.newer_pages(pages, 'updated_at', since)
 
-            while(pages_exist):
-                parameters['page'] = page_number
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/pulls', parameters)
+            for page in pages:
+                page = [pull_request for pull_request in page if pull_request and 'number' in pull_request]
 
-                if request:
-                    for pull_request in request:
-                        if pull_request:
-                            if 'number' in pull_request:
-                                pull_request = self.pull_request(pull_request['number'])
-                                pull_request['reviews'] = self.pull_request_reviews(pull_request['number'])
-                                pull_request['comments'] = self.pull_request_comments(pull_request['number'])
-                                pull_requests.append(pull_request)
+                if self.fan_out:
+                    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                        yield list(executor.map(details, page))
                 else:
-                    pages_exist = False
+                    yield [details(pull_request) for pull_request in page]
 
-                page_number = page_number + 1
+        # The journal keeps the pages with their details, reviews and comments.
+        pages = self.resume(fetch, ['/pulls', parameters, since, 'details'], journal=journal)
+        return (pull_request for page in pages for pull_request in page)
 
-        return pull_requests
+    def pull_requests(self, state=None, direction=None, sort=None, base=None, head=None, since=None, page_range={}, journal=None, bulk=False, comment_journals=(None, None), compact=None):
+        return list(self.iter_pull_requests(state, direction, sort, base, head, since, page_range, journal, bulk, comment_journals, compact))
 
-    def pull_request_reviews(self, number, page_range={}):
-        reviews = []
-        if page_range:
-            first_page = page_range['first_page']
-            last_page = page_range['last_page']
+    def grouped(self, resource, url_field, field, compact=None, journal=None):
+        # Groups a repository-wide listing of comments by the number at the
+        # end of url_field (e.g. .../pulls/42 or .../issues/42). Each page is
+        # reduced to [number, item] pairs as it arrives (items go through
+        # compact), and that is what the journal keeps.
+        parameters = {'sort': 'created', 'direction': 'asc'}
 
-            for page_number in range(first_page, last_page):
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/pulls' + '/' + str(number) + '/comments', {'page': str(page_number)})
+        def fetch(page_range):
+            for page in self.pages(resource, parameters, page_range=page_range):
+                pairs = []
 
-                if request:
-                    for review in request:
-                        reviews.append(review)
-        else:
-            pages_exist = True
-            page_number = 1
+                for item in page:
+                    # Comments on plain issues (html_url .../issues/42#...) are
+                    # left out, only pull-requests are joined.
+                    if item and item.get(url_field) and '/pull/' in item.get('html_url', '/pull/'):
+                        number = int(item[url_field].rstrip('/').split('/')[-1])
+                        pairs.append([number, compact(field, item) if compact is not None else item])
 
-            while(pages_exist):
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/pulls' + '/' + str(number) + '/comments', {'page': str(page_number)})
+                yield pairs
 
-                if request:
-                    for review in request:
-                        reviews.append(review)
-                else:
-                    pages_exist = False
+        groups = {}
 
-                page_number = page_number + 1
-
-        return reviews
+        for page in self.resume(fetch, [resource, parameters, 'grouped', compact is not None], journal=journal):
+            for number, item in page:
+                groups.setdefault(number, []).append(item)
 
-    def pull_request_comments(self, number, page_range={}):
-        comments = []
-        
-        if page_range:
-            first_page = page_range['first_page']
-            last_page = page_range['last_page']
+        return groups
 
-            for page_number in range(first_page, last_page):
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/issues' + '/' + str(number) + '/comments', {'page': str(page_number)})
+    def pull_request_join(self, pull_request, reviews, comments):
+        number = pull_request['number']
 
-                if request:
-                    for comment in request:
-                        comments.append(comment)
+        if pull_request.get('merged_at') is not None:
+            details = self.pull_request(number)
+            if details:
+                pull_request = details
         else:
-            pages_exist = True
-            page_number = 1
+            pull_request['merged_by'] = None
 
-            while(pages_exist):
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/issues' + '/' + str(number) + '/comments', {'page': str(page_number)})
+        pull_request['reviews'] = reviews.get(number, [])
+        pull_request['comments'] = comments.get(number, [])
+        return pull_request
 
-                if request:
-                    for comment in request:
-                        comments.append(comment)
-                else:
-                    pages_exist = False
+    def pull_request_details(self, number):
+        pull_request = self.pull_request(number)
 
-                page_number = page_number + 1
+        if pull_request:
+            pull_request['reviews'] = self.pull_request_reviews(number)
+            pull_request['comments'] = self.pull_request_comments(number)
 
-        return comments
+        return pull_request
 
+    def pull_request_reviews(self, number, page_range={}):
+        return self.listing('/pulls/' + str(number) + '/comments', page_range=page_range)
 
-    def issues(self, state=None, direction=None, milestone=None, labels=None, creator=None, since=None, assignee=None, mentioned=None, page_range={}):
-        print('[Repository] Returning issues available in ' + self.name)
+    def pull_request_comments(self, number, page_range={}):
+        return self.listing('/issues/' + str(number) + '/comments', page_range=page_range)
 
-        issues = []
+    def iter_issues(self, state=None, direction=None, milestone=None, labels=None, creator=None, since=None, assignee=None, mentioned=None, page_range={}, journal=None):
+        logger.info('[Repository] Returning issues available in ' + self.name)
         parameters = {}
 
         if state is not None:
@@ -238,140 +360,51 @@ class Repository:
         if assignee is not None:
             parameters['assignee'] = assignee
 
-        if page_range:
-            first_page = page_range['first_page']
-            last_page = page_range['last_page']
-
-            for page_number in range(first_page, last_page):
-                parameters['page'] = page_number
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/issues', parameters)
-
-                if request:
-                    for issue in request:
-                        issues.append(issue)
-        else:
-            pages_exist = True
-            page_number = 1
-
-            while(pages_exist):
-                parameters['page'] = page_number
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/issues', parameters)
-
-                if request:
-                    for issue in request:
-                        issues.append(issue)
-                else:
-                    pages_exist = False
-
-                page_number = page_number + 1
-
-        return issues
+        return self.items('/issues', parameters, page_range=page_range, journal=journal)
 
-    def contributors(self, anonymous='false', page_range={}):
-        print('[Repository] Returning contributors of ' + self.name)
+    def issues(self, state=None, direction=None, milestone=None, labels=None, creator=None, since=None, assignee=None, mentioned=None, page_range={}, journal=None):
+        return list(self.iter_issues(state, direction, milestone, labels, creator, since, assignee, mentioned, page_range, journal))
 
-        contributors = []
+    def iter_contributors(self, anonymous='false', page_range={}, journal=None):
+        logger.info('[Repository] Returning contributors of ' + self.name)
         parameters = {}
 
         if anonymous:
             parameters['anonymous'] = anonymous
 
-        if page_range:
-            first_page = page_range['first_page']
-            last_page = page_range['last_page']
-
-            for page_number in range(first_page, last_page):
-                parameters['page'] = page_number
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/contributors', parameters)
+        return self.items('/contributors', parameters, page_range=page_range, journal=journal)
 
-                if request:
-                    for contributor in request:
-                        contributors.append(contributor)
-        else:
-            pages_exist = True
-            page_number = 1
+    def contributors(self, anonymous='false', page_range={}, journal=None):
+        return list(self.iter_contributors(anonymous, page_range, journal))
 
-            while(pages_exist):
-                parameters['page'] = page_number
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/contributors', parameters)
+    def iter_stars(self, since=None, page_range={}, journal=None):
+        logger.info('[Repository] Returning stars available in ' + self.name)
+        stars = self.items('/stargazers', headers={'Accept': 'application/vnd.github.v3.star+json'}, page_range=page_range, journal=journal)
 
-                if request:
-                    for contributor in request:
-                        contributors.append(contributor)
-                else:
-                    pages_exist = False
-
-                page_number = page_number + 1
-
-        return contributors
-
-
-    def stars(self, page_range={}):
-        print('[Repository] Returning stars available in ' + self.name)
-
-        stars = []
-
-        if page_range:
-            first_page = page_range['first_page']
-            last_page = page_range['last_page']
-
-            for page_number in range(first_page, last_page):
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/stargazers', {'page': str(page_number)}, {'Accept': 'application/vnd.github.v3.star+json'})
-
-                if request:
-                    for star in request:
-                        stars.append(star)
-        else:
-            pages_exist = True
-            page_number = 1
-
-            while(pages_exist):
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/stargazers', {'page': str(page_number)}, {'Accept': 'application/vnd.github.v3.star+json'})
-
-                if request:
-                    for star in request:
-                        stars.append(star)
-                else:
-                    pages_exist = False
-
-                page_number = page_number + 1
+        # Stargazers are listed from oldest to newest, so since can only filter
+        # them. Use an open page range ({'first_page': n}) to skip known pages.
+        if since is not None:
+            stars = (star for star in stars if star.get('starred_at') and star['starred_at'] > since)
 
         return stars
 
-    def forks(self, sort=None, page_range={}):
-        print('[Repository] Returning forks available in ' + self.name)
+    def stars(self, since=None, page_range={}, journal=None):
+        return list(self.iter_stars(since, page_range, journal))
 
-        forks = []
+    def iter_forks(self, sort=None, since=None, page_range={}, journal=None):
+        logger.info('[Repository] Returning forks available in ' + self.name)
         parameters = {}
 
         if sort is not None:
             parameters['sort'] = sort
 
-        if page_range:
-            first_page = page_range['first_page']
-            last_page = page_range['last_page']
-
-            for page_number in range(first_page, last_page):
-                parameters['page'] = page_number
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/forks', parameters)
+        if since is None:
+            return self.items('/forks', parameters, page_range=page_range, journal=journal)
 
-                if request:
-                    for fork in request:
-                        forks.append(fork)
-        else:
-            pages_exist = True
-            page_number = 1
-
-            while(pages_exist):
-                parameters['page'] = page_number
-                request = self.github.request('repos/' + self.organization + '/' + self.name + '/forks', parameters)
-
-                if request:
-                    for fork in request:
-                        forks.append(fork)
-                else:
-                    pages_exist = False
-
-                page_number = page_number + 1
+        # With sort='newest', the listing stops at the first fork created before since.
+        fetch = lambda page_range: self.newer_pages(self.pages('/forks', parameters, page_range=page_range), 'created_at', since)
+        pages = self.resume(fetch, ['/forks', parameters, since], page_range, journal)
+        return (fork for page in pages for fork in page)
 
-        return forks
+    def forks(self, sort=None, since=None, page_range={}, journal=None):
+        return list(self.iter_forks(sort, since, page_range, journal))
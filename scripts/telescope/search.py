@@ -4,10 +4,28 @@
 __author__ =  'Felipe Fronchetti'
 __contact__ = 'fronchetti@usp.br'
 
+import logging
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from telescope.repository import page_window
+from telescope.collector import CollectorError
+
+logger = logging.getLogger(__name__)
+
+# GitHub returns at most 1000 results of a search, whatever the pagination.
+SEARCH_LIMIT = 1000
+# No repository was created before GitHub went online.
+FIRST_DAY = date(2007, 10, 1)
+
 class Search:
 
-    def __init__(self, collector):
+    def __init__(self, collector, per_page=100, workers=10):
         self.github = collector
+        # Items requested per page (GitHub accepts up to 100).
+        self.per_page = per_page
+        # Slices are counted and fetched concurrently by a pool of threads.
+        # Keep workers <= the collector pool size.
+        self.workers = workers
 
     def repositories(self, keywords=None, sort=None, order=None, page_range={}):
         repositories = []
@@ -22,16 +40,121 @@ class Search:
         if order is not None:
             parameters['order'] = order
 
+        parameters['per_page'] = self.per_page
+
         if page_range:
-            first_page = page_range['first_page']
-            last_page = page_range['last_page']
+            first_page, last_page, skip, remaining = page_window(page_range, self.per_page)
 
             for page_number in range(first_page, last_page):
                 parameters['page'] = page_number
                 request = self.github.request('search/repositories', parameters)
+
+                if request and 'items' in request:
+                    request['items'] = request['items'][skip:skip + remaining]
+                    skip = 0
+                    remaining = remaining - len(request['items'])
+
                 repositories.append(request)
 
             return repositories
         else:
             repositories = self.github.request( 'search/repositories', parameters)
             return repositories
+
+    def harvest(self, keywords, min_stars=0, max_stars=None):
+        # Returns every repository matching the keywords with at least
+        # min_stars stars, beyond the 1000 results of a single search. The
+        # query is split in stars: ranges (and created: windows, when a single
+        # number of stars has too many repositories) until each slice fits
+        # in one search, then all the pages of all the slices are fetched at
+        # once. Repositories are deduplicated by id and sorted by stars.
+        # CollectorError is raised when a slice can't be counted or fetched,
+        # rather than returning the repositories of the other slices only.
+        if max_stars is None:
+            top = self.github.request('search/repositories', {'q': keywords + ' stars:>=' + str(min_stars), 'sort': 'stars', 'order': 'desc', 'per_page': 1})
+            if not top or not top.get('items'):
+                return []
+            max_stars = top['items'][0]['stargazers_count']
+
+        slices = self.slices(keywords, [(min_stars, max_stars, FIRST_DAY, date.today())])
+        searches = []
+
+        for query, count in slices:
+            pages = -(-min(count, SEARCH_LIMIT) // self.per_page)
+            for page_number in range(1, pages + 1):
+                searches.append({'q': query, 'per_page': self.per_page, 'page': page_number})
+
+        logger.info('[Search] ' + str(len(slices)) + ' slices, ' + str(len(searches)) + ' pages of: ' + keywords)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pages = list(executor.map(self.search, searches))
+
+        repositories = {}
+
+        for request in pages:
+            for repository in request['items']:
+                repositories[repository['id']] = repository
+
+        return sorted(repositories.values(), key=lambda repository: repository['stargazers_count'], reverse=True)
+
+    def slices(self, keywords, windows):
+        # Splits (min stars, max stars, first day, last day) windows in halves
+        # until each one has at most SEARCH_LIMIT results. Every round counts
+        # the pending windows concurrently. Returns (query, count) pairs.
+        slices = []
+
+        while windows:
+            queries = [self.slice_query(keywords, window) for window in windows]
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                counts = list(executor.map(self.count, queries))
+
+            pending = []
+
+            for window, query, count in zip(windows, queries, counts):
+                low, high, first_day, last_day = window
+
+                if count == 0:
+                    continue
+                elif count <= SEARCH_LIMIT:
+                    slices.append((query, count))
+                elif low < high:
+                    middle = (low + high) // 2
+                    pending.append((low, middle, first_day, last_day))
+                    pending.append((middle + 1, high, first_day, last_day))
+                elif first_day < last_day:
+                    middle = first_day + timedelta(days=(last_day - first_day).days // 2)
+                    pending.append((low, high, first_day, middle))
+                    pending.append((low, high, middle + timedelta(days=1), last_day))
+                else:
+                    # A single day with more than 1000 repositories with the
+                    # same number of stars, only the first 1000 are returned.
+                    logger.warning('[Search] More than ' + str(SEARCH_LIMIT) + ' results in: ' + query)
+                    slices.append((query, count))
+
+            windows = pending
+
+        return slices
+
+    def slice_query(self, keywords, window):
+        low, high, first_day, last_day = window
+        query = keywords + ' stars:' + str(low) + '..' + str(high)
+
+        if first_day > FIRST_DAY or last_day < date.today():
+            query = query + ' created:' + first_day.isoformat() + '..' + last_day.isoformat()
+
+        return query
+
+    def search(self, parameters):
+        # A page of results. The collector already retried the failed
+        # requests, a page without items (422 for an invalid query...) is
+        # an error.
+        request = self.github.request('search/repositories', parameters)
+
+        if not isinstance(request, dict) or 'items' not in request or 'total_count' not in request:
+            raise CollectorError('[Search] No results for: ' + parameters['q'] + ' ' + str(request)[:200], self.github.api_url + 'search/repositories', None)
+
+        return request
+
+    def count(self, query):
+        return self.search({'q': query, 'per_page': 1})['total_count']